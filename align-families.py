@@ -2,21 +2,34 @@
 import os
 import sys
 import time
+import typing
 import logging
+import operator
+import hashlib
 import argparse
-import tempfile
 import resource
+import threading
 import subprocess
 import collections
+import concurrent.futures
 import distutils.spawn
 import parallel_tools
-import seqtools
 import shims
 # There can be problems with the submodules, but none are essential.
 # Try to load these modules, but if there's a problem, load a harmless dummy and continue.
 simplewrap = shims.get_module_or_shim('utillib.simplewrap')
 version = shims.get_module_or_shim('utillib.version')
 phone = shims.get_module_or_shim('ET.phone')
+# The kalign module is imported lazily, by make_msa_kalign(), the first time it's needed.
+kalign = None
+# Same for spoa's poa() function, by make_msa_spoa().
+spoa_poa = None
+# With --cache-msa, each process keeps the alignments of this many recent families.
+MSA_CACHE_SIZE = 4096
+msa_cache = collections.OrderedDict()
+msa_cache_lock = threading.Lock()
+# With --mate-threads, each process creates a thread pool the first time it's needed.
+mate_executor = None
 
 #TODO: Warn if it looks like the two input FASTQ files are the same (i.e. the _1 file was given
 #      twice). Can tell by whether the alpha and beta (first and last 12bp) portions of the barcodes
@@ -27,6 +40,10 @@ phone = shims.get_module_or_shim('ET.phone')
 USAGE = """$ %(prog)s [options] families.tsv > families.msa.tsv
        $ cat families.tsv | %(prog)s [options] > families.msa.tsv"""
 DESCRIPTION = """Read in sorted FASTQ data and do multiple sequence alignments of each family."""
+# How many bytes of output to accumulate before writing to stdout.
+OUTPUT_BUFFER_SIZE = 1024*1024
+# How many bytes of input to read at once.
+INPUT_BUFFER_SIZE = 1024*1024
 
 def make_argparser():
 
@@ -36,8 +53,8 @@ def make_argparser():
                                    formatter_class=argparse.RawTextHelpFormatter)
 
   wrapper.width = wrapper.width - 24
-  parser.add_argument('infile', metavar='read-families.tsv', nargs='?', default=sys.stdin,
-                      type=argparse.FileType('r'),
+  parser.add_argument('infile', metavar='read-families.tsv', nargs='?', default=sys.stdin.buffer,
+                      type=argparse.FileType('rb', bufsize=INPUT_BUFFER_SIZE),
     help=wrap('The input reads, sorted into families. One line per read pair, 8 tab-delimited '
               'columns:\n'
               '1. canonical barcode\n'
@@ -48,8 +65,26 @@ def make_argparser():
               '6. read 2 name\n'
               '7. read 2 sequence\n'
               '8. read 2 quality scores'))
-  parser.add_argument('-a', '--aligner', choices=('mafft', 'kalign', 'dummy'), default='kalign',
-    help=wrap('The multiple sequence aligner to use. Default: %(default)s'))
+  parser.add_argument('-a', '--aligner', choices=('mafft', 'kalign', 'spoa', 'dummy'),
+    default='kalign',
+    help=wrap('The multiple sequence aligner to use. "spoa" does partial order alignment in this '
+              'process, through the pyspoa module (must be installed separately). Default: '
+              '%(default)s'))
+  parser.add_argument('--mafft-threads', type=int, default=1,
+    help=wrap('Number of threads each mafft process should use, when using --aligner mafft. The '
+              'default of %(default)s is best when there are several worker --processes, each '
+              'running its own mafft on small families. More threads per mafft would just '
+              'compete for the same cores.'))
+  parser.add_argument('--mate-threads', type=int, default=1,
+    help=wrap('Within each worker process, align up to this many of a duplex\'s families (its '
+              'strands and mates) at the same time. Only applies to --aligner mafft, since each '
+              'alignment is a separate mafft process. Useful when there are spare cores beyond '
+              'the worker --processes. Default: %(default)s'))
+  parser.add_argument('--tmpdir',
+    help=wrap('Have mafft put its temporary files in this directory, by setting $TMPDIR for it. '
+              'mafft creates and deletes a scratch directory there for every family it aligns, so '
+              'a directory in memory like /dev/shm can save a lot of disk access. Only applies to '
+              '--aligner mafft. Default: mafft\'s own default ($TMPDIR, or /tmp).'))
   parser.add_argument('-I', '--no-check-ids', dest='check_ids', action='store_false', default=True,
     help=wrap("Don't check to make sure read pairs have identical ids. By default, if this "
               "encounters a pair of reads in families.tsv with ids that aren't identical (minus an "
@@ -62,6 +97,14 @@ def make_argparser():
     help=wrap('How long to go accumulating responses from worker subprocesses before dealing '
               f'with all of them. Default: {parallel_tools.QUEUE_SIZE_MULTIPLIER} * the number of '
               'worker --processes.'))
+  parser.add_argument('--duplex-batch', type=int, default=16,
+    help=wrap('How many duplexes to send to a worker process at once. Batching saves on the '
+              'overhead of communicating with the workers, which can be comparable to the time '
+              'it takes to align small families. Default: %(default)s'))
+  parser.add_argument('--cache-msa', action='store_true',
+    help=wrap('Remember the alignments of recent families, and reuse them when a family with the '
+              'same sequences (in the same order) comes up again. Each worker keeps the last '
+              f'{MSA_CACHE_SIZE} alignments. This helps with low-complexity libraries.'))
   parser.add_argument('--phone-home', action='store_true',
     help=wrap('Report helpful usage data to the developer, to better understand the use cases and '
               'performance of the tool. The only data which will be recorded is the name and '
@@ -88,6 +131,17 @@ def make_argparser():
   return parser
 
 
+class Pair(typing.NamedTuple):
+  """One read pair from the input. Much lighter than a dict, both in memory and when pickled.
+  All fields are kept as the raw bytes read from the input."""
+  name1: bytes
+  seq1: bytes
+  qual1: bytes
+  name2: bytes
+  seq2: bytes
+  qual2: bytes
+
+
 def main(argv):
 
   parser = make_argparser()
@@ -103,7 +157,7 @@ def main(argv):
                       fail='warn')
     call.send_data('start')
     data = {
-      'stdin': args.infile is sys.stdin,
+      'stdin': args.infile is sys.stdin.buffer,
       'aligner': args.aligner,
       'processes': args.processes,
       'queue_size': args.queue_size,
@@ -119,28 +173,55 @@ def main(argv):
   try:
     if args.queue_size is not None and args.queue_size <= 0:
       fail('Error: --queue-size must be greater than zero.')
+    if args.duplex_batch <= 0:
+      fail('Error: --duplex-batch must be greater than zero.')
+    if args.mafft_threads <= 0:
+      fail('Error: --mafft-threads must be greater than zero.')
+    if args.mate_threads <= 0:
+      fail('Error: --mate-threads must be greater than zero.')
 
     # If we're using mafft, check that we can execute it.
-    if args.aligner == 'mafft' and not distutils.spawn.find_executable('mafft'):
-      fail('Error: Could not find "mafft" command on $PATH.')
+    # Resolve its path once here so the workers don't have to search $PATH on every call.
+    aligner_path = None
+    if args.aligner == 'mafft':
+      aligner_path = distutils.spawn.find_executable('mafft')
+      if not aligner_path:
+        fail('Error: Could not find "mafft" command on $PATH.')
+      # mafft can't be kept running between families: it reads all its input before aligning. But
+      # every run creates and deletes a scratch directory in $TMPDIR. Let the user move those
+      # somewhere faster. The workers inherit the environment.
+      if args.tmpdir:
+        if not (os.path.isdir(args.tmpdir) and os.access(args.tmpdir, os.W_OK)):
+          fail(f'Error: --tmpdir {args.tmpdir!r} is not a writable directory.')
+        logging.info(f'Setting $TMPDIR to {args.tmpdir!r} for mafft.')
+        os.environ['TMPDIR'] = args.tmpdir
 
     # Open a pool of worker processes.
     stats = {'duplexes':0, 'time':0, 'pairs':0, 'runs':0, 'failures':0, 'aligned_pairs':0}
+    # Write the output in large blocks instead of one small write per duplex.
+    outfile = open(sys.stdout.fileno(), 'wb', buffering=OUTPUT_BUFFER_SIZE, closefd=False)
+    static_kwargs = {
+      'aligner':args.aligner, 'aligner_path':aligner_path, 'aligner_threads':args.mafft_threads,
+      'cache_msa':args.cache_msa,
+      'check_ids':args.check_ids, 'mate_threads':args.mate_threads
+    }
     pool = parallel_tools.SyncAsyncPool(
-      process_duplex, processes=args.processes, static_kwargs={'aligner':args.aligner},
-      queue_size=args.queue_size, callback=process_result, callback_args=[stats]
+      process_duplex, processes=args.processes, static_kwargs=static_kwargs,
+      queue_size=args.queue_size, callback=process_result, callback_args=[stats, outfile],
+      batch_size=args.duplex_batch
     )
 
     try:
       # The main loop.
-      align_families(args.infile, pool, stats, check_ids=args.check_ids)
+      align_families(args.infile, pool, stats)
     finally:
       # If an exception occurs in the parent without stopping the child processes, this will hang.
       # Make sure to kill the children in all cases.
       pool.close()
       pool.join()
+      outfile.flush()
       # Close input filehandle if it's open.
-      if args.infile is not sys.stdin:
+      if args.infile is not sys.stdin.buffer:
         args.infile.close()
 
     # Final stats on the run.
@@ -194,9 +275,9 @@ def get_max_mem():
 
 
 def get_run_data(stats, pool, aligner, max_mem=None):
-  run_data = stats.copy()
-  run_data['align_time'] = run_data['time']
-  del run_data['time']
+  # Build a fresh dict instead of copying the stats and then renaming keys in the copy.
+  run_data = {key:value for key, value in stats.items() if key != 'time'}
+  run_data['align_time'] = stats['time']
   if max_mem is not None:
     run_data['mem'] = max_mem
   run_data['processes'] = pool.processes
@@ -205,244 +286,430 @@ def get_run_data(stats, pool, aligner, max_mem=None):
   return run_data
 
 
-def align_families(infile, pool, stats, check_ids=True):
+def align_families(infile, pool, stats):
   """The main loop.
   This processes whole duplexes (pairs of strands) at a time for a future option to align the
   whole duplex at a time.
+  The input is read as binary, and everything stays bytes all the way to the output.
+  This only looks at the barcode and order of each line, which is all that's needed to group the
+  lines into duplexes. The lines themselves are parsed by the workers (see parse_family()), so that
+  parsing is spread across processes instead of bottlenecking the main one.
   duplex data structure:
-  duplex = {
-    'ab': [
-      {'name1': 'read_name1a',
-        'seq1':  'GATT-ACA',
-        'qual1': 'sc!0 /J*',
-        'name2': 'read_name1b',
-        'seq2':  'ACTGACTA',
-        'qual2': '34I&SDF)'
-      },
-      {'name1': 'read_name2a',
-        ...
-      },
-      ...
-    ],
-    'ba': [
-      ...
-    ]
-  }
+  A list of (order, data) tuples, one per strand, in the order they appear in the input. The data
+  is the family's input lines, unparsed and joined with newlines into a single bytes object, so it
+  can be sent to a worker as one object instead of one per read. There are never more than two
+  strands, so this is lighter than a dict.
+  duplex = [
+    (b'ab', b'CTCAGGTGAAGC\tab\tread_name1a\tGATT-ACA\tsc!0 /J*\tread_name1b\tACTGACTA\t34I&SDF)\n'
+            b'CTCAGGTGAAGC\tab\tread_name2a\t...'),
+    (b'ba', b'...')
+  ]
   e.g.:
-  seq = duplex[order][pair_num]['seq1']"""
-  duplex = collections.OrderedDict()
+  order, data = duplex[strand_num]"""
+  duplex = []
   family = []
+  family_key = None
   barcode = None
   order = None
-  for line in infile:
-    fields = line.rstrip('\r\n').split('\t')
-    if len(fields) != 8:
+  # This loop runs once per read pair, so keep the work in it to a minimum.
+  add_line = family.append
+  for line in read_lines(infile):
+    # Skip lines without exactly 8 columns before they can change the family key, so a malformed
+    # line doesn't split the family (or duplex) it's in.
+    if line.count(b'\t') != 7:
       continue
-    (this_barcode, this_order, name1, seq1, qual1, name2, seq2, qual2) = fields
-    if check_ids:
-      assert_read_ids_match(name1, name2)
+    # The "family key" is the barcode and order columns together (everything up to the 2nd tab).
+    # Checking it takes one comparison, and the barcode and order only need to be split out of it
+    # when it changes.
+    key_end = line.find(b'\t', line.find(b'\t')+1)
+    this_family_key = line[:key_end]
     # If the barcode or order has changed, we're in a new family.
     # Process the reads we've previously gathered as one family and start a new family.
-    if this_barcode != barcode or this_order != order:
-      duplex[order] = family
+    if this_family_key != family_key:
+      this_barcode, this_order = this_family_key.split(b'\t')
+      family_key = this_family_key
+      duplex.append((order, b'\n'.join(family)))
       # If the barcode is different, we're at the end of the whole duplex. Process the it and start
       # a new one. If the barcode is the same, we're in the same duplex, but we've switched strands.
       if this_barcode != barcode:
-        # orders_str = '/'.join([str(len(duplex[o])) for o in duplex]
-        # logging.debug(f'processing {barcode}: {len(duplex)} orders ({orders_str})'
         if barcode is not None:
-          pool.compute(duplex, barcode)
+          submit_duplex(pool, duplex, barcode)
           stats['duplexes'] += 1
-        duplex = collections.OrderedDict()
+        duplex = []
       barcode = this_barcode
       order = this_order
       family = []
-    pair = {'name1': name1, 'seq1':seq1, 'qual1':qual1, 'name2':name2, 'seq2':seq2, 'qual2':qual2}
-    family.append(pair)
-    stats['pairs'] += 1
+      add_line = family.append
+    add_line(line)
   # Process the last family.
-  duplex[order] = family
-  # orders_str = '/'.join([str(len(duplex[o])) for o in duplex]
-  # logging.debug(f'processing {barcode}: {len(duplex)} orders ({orders_str})'
-  pool.compute(duplex, barcode)
+  duplex.append((order, b'\n'.join(family)))
+  submit_duplex(pool, duplex, barcode)
   stats['duplexes'] += 1
   # Retrieve the remaining results.
   logging.info('Flushing remaining results from worker processes..')
   pool.flush()
 
 
+def read_lines(infile, chunk_size=INPUT_BUFFER_SIZE):
+  """Read a binary file in large chunks and yield its lines (without line endings).
+  This splits each chunk into lines in one call, instead of making a readline() call per line."""
+  tail = b''
+  while True:
+    chunk = infile.read(chunk_size)
+    if not chunk:
+      break
+    lines = (tail+chunk).split(b'\n')
+    # The last piece is a partial line (or empty). Save it for the next chunk.
+    tail = lines.pop()
+    yield from lines
+  if tail:
+    yield tail
+
+
+def parse_family(data, check_ids=True):
+  """Parse a family's input lines (joined into one bytes object) into a list of Pairs.
+  Lines without exactly 8 columns are skipped."""
+  family = []
+  # This runs once per read, so bind what the loop uses to locals.
+  add_pair = family.append
+  make_pair = Pair
+  for line in data.split(b'\n'):
+    # Stop splitting after the last field. Anything left in it means the line had too many.
+    fields = line.split(b'\t', 7)
+    if len(fields) != 8:
+      continue
+    barcode, order, name1, seq1, qual1, name2, seq2, qual2 = fields
+    qual2 = qual2.rstrip(b'\r\n')
+    if b'\t' in qual2:
+      continue
+    if check_ids:
+      assert_read_ids_match(name1, name2)
+    add_pair(make_pair(name1, seq1, qual1, name2, seq2, qual2))
+  return family
+
+
+def submit_duplex(pool, duplex, barcode):
+  """Send a duplex off to be processed.
+  If every family in it is a single read pair (a single line), there's nothing to align, so it's
+  processed right here instead of paying to ship it to a worker process."""
+  if all(b'\n' not in data for order, data in duplex):
+    pool.compute_locally(duplex, barcode)
+  else:
+    pool.compute(duplex, barcode)
+
+
 def assert_read_ids_match(name1, name2):
-  id1 = name1.split()[0]
-  id2 = name2.split()[0]
-  if id1.endswith('/1'):
+  # partition() avoids building a list of every field just to take the first.
+  id1 = name1.partition(b' ')[0]
+  id2 = name2.partition(b' ')[0]
+  if id1.endswith(b'/1'):
     id1 = id1[:-2]
-  if id2.endswith('/2'):
+  if id2.endswith(b'/2'):
     id2 = id2[:-2]
   if id1 == id2:
     return True
-  elif id1.endswith('/2') and id2.endswith('/1'):
+  elif id1.endswith(b'/2') and id2.endswith(b'/1'):
     raise ValueError(
       f'Read names not as expected. Mate 1 ends with /2 and mate 2 ends with /1:\n'
-      f'  Mate 1: {name1!r}\n  Mate 2: {name2!r}'
+      f'  Mate 1: {name1.decode()!r}\n  Mate 2: {name2.decode()!r}'
     )
   else:
-    raise ValueError(f'Read names {name1!r} and {name2!r} do not match.')
-
-
-def process_duplex(duplex, barcode, aligner='mafft'):
-  output = ''
-  orders_str = '", "'.join(map(str, duplex.keys()))
-  logging.debug(f'Starting {barcode} (orders "{orders_str}")')
-  run_stats = {'time':0, 'runs':0, 'aligned_pairs':0, 'failures':0}
-  orders = tuple(duplex.keys())
-  if len(duplex) == 0 or None in duplex:
-    logging.warning(f'Empty duplex {barcode}.')
-    return '', {}
-  elif len(duplex) == 1:
+    raise ValueError(f'Read names {name1.decode()!r} and {name2.decode()!r} do not match.')
+
+
+def process_duplex(
+    duplex, barcode, aligner='mafft', aligner_path=None, aligner_threads=1, cache_msa=False,
+    check_ids=True, mate_threads=1
+  ):
+  output = []
+  # The barcode and orders are bytes. Decode them for log messages.
+  barcode_str = barcode.decode() if barcode is not None else barcode
+  # Run statistics, returned as a tuple: (pairs, time, runs, aligned_pairs, failures).
+  pairs_total = 0
+  run_time = 0
+  runs = 0
+  aligned_pairs = 0
+  failures = 0
+  orders = tuple(order for order, data in duplex)
+  if len(orders) == 0 or None in orders:
+    logging.warning(f'Empty duplex {barcode_str}.')
+    return b'', (0, 0, 0, 0, 0)
+  # Parse the raw lines into read pairs, dropping any strands left empty by invalid lines.
+  parsed_duplex = []
+  for order, data in duplex:
+    family = parse_family(data, check_ids=check_ids)
+    if family:
+      parsed_duplex.append((order, family))
+      pairs_total += len(family)
+  duplex = parsed_duplex
+  orders = tuple(order for order, family in duplex)
+  if len(orders) == 0:
+    return b'', (0, 0, 0, 0, 0)
+  orders_str = '", "'.join([order.decode() for order in orders])
+  logging.debug(f'Starting {barcode_str} (orders "{orders_str}")')
+  if len(orders) == 1:
     # If there's only one strand in the duplex, just process the first mate, then the second.
-    combos = ((1, orders[0]), (2, orders[0]))
-  elif len(duplex) == 2:
+    combos = ((1, 0), (2, 0))
+  elif len(orders) == 2:
     # If there's two strands, process in a criss-cross order:
     # strand1/mate1, strand2/mate2, strand1/mate2, strand2/mate1
-    combos = ((1, orders[0]), (2, orders[1]), (2, orders[0]), (1, orders[1]))
+    combos = ((1, 0), (2, 1), (2, 0), (1, 1))
   else:
-    raise AssertionError(f'More than 2 orders in duplex {barcode}: {orders}')
-  for mate, order in combos:
-    family = duplex[order]
-    start = time.time()
-    try:
-      alignment = align_family(family, mate, aligner=aligner)
-    except AssertionError as error:
-      logging.exception(f'While processing duplex {barcode}, order {order}, mate {mate}:')
-      raise
-    except (OSError, subprocess.CalledProcessError) as error:
-      logging.warning(
-        f'{type(error).__name__} on family {barcode}, order {order}, mate {mate}:\n{error}'
-      )
-      alignment = None
+    raise AssertionError(f'More than 2 orders in duplex {barcode_str}: {orders_str}')
+  align_kwargs = {
+    'aligner':aligner, 'aligner_path':aligner_path, 'aligner_threads':aligner_threads,
+    'cache_msa':cache_msa
+  }
+  jobs = [(duplex[strand], mate) for mate, strand in combos]
+  def align_job(job):
+    (order, family), mate = job
+    return time_align_family(family, mate, barcode_str, order.decode(), align_kwargs)
+  # mafft runs in its own process, so threads can overlap the alignments of a duplex's families.
+  # But only bother when at least two of them actually need mafft.
+  if (mate_threads > 1 and aligner == 'mafft' and
+      sum(1 for (order, family), mate in jobs if needs_alignment(family, mate)) > 1):
+    results = get_mate_executor(mate_threads).map(align_job, jobs)
+  else:
+    results = map(align_job, jobs)
+  for ((order, family), mate), (alignment, elapsed) in zip(jobs, results):
     # Compile statistics.
-    elapsed = time.time() - start
     pairs = len(family)
     logging.debug(f'{elapsed} sec for {pairs} read pairs.')
     if pairs > 1:
-      run_stats['time'] += elapsed
-      run_stats['runs'] += 1
-      run_stats['aligned_pairs'] += pairs
+      run_time += elapsed
+      runs += 1
+      aligned_pairs += pairs
     if alignment is None:
-      logging.warning(f'Error aligning family {barcode}/{order} (read {mate}).')
-      run_stats['failures'] += 1
+      logging.warning(f'Error aligning family {barcode_str}/{order.decode()} (read {mate}).')
+      failures += 1
     else:
-      output += format_msa(alignment, barcode, order, mate)
-  return output, run_stats
+      output.extend(format_msa(alignment, barcode, order, mate))
+  # Join all the lines from the whole duplex at once.
+  output.append(b'')
+  return b'\n'.join(output), (pairs_total, run_time, runs, aligned_pairs, failures)
+
 
+def time_align_family(family, mate, barcode_str, order_str, align_kwargs):
+  """Run align_family() and time it. Returns (alignment, elapsed_seconds).
+  Failures of the aligner are logged and give an alignment of None."""
+  start = time.time()
+  try:
+    alignment = align_family(family, mate, **align_kwargs)
+  except AssertionError as error:
+    logging.exception(f'While processing duplex {barcode_str}, order {order_str}, mate {mate}:')
+    raise
+  except (OSError, subprocess.CalledProcessError) as error:
+    logging.warning(
+      f'{type(error).__name__} on family {barcode_str}, order {order_str}, mate {mate}:\n{error}'
+    )
+    alignment = None
+  return alignment, time.time() - start
 
-def align_family(family, mate, aligner='mafft'):
-  """Do a multiple sequence alignment of the reads in a family and their quality scores."""
+
+def needs_alignment(family, mate):
+  """Whether align_family() will have to run the aligner for this mate of the family (it has more
+  than one read, and they aren't all identical)."""
+  if len(family) <= 1:
+    return False
+  seq_attr = 'seq'+str(mate)
+  first_seq = getattr(family[0], seq_attr)
+  return any(getattr(pair, seq_attr) != first_seq for pair in family)
+
+
+def get_mate_executor(threads):
+  """Get this process' thread pool for aligning families concurrently, creating it if needed."""
+  global mate_executor
+  if mate_executor is None:
+    mate_executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+  return mate_executor
+
+
+def align_family(
+    family, mate, aligner='mafft', aligner_path=None, aligner_threads=1, cache_msa=False
+  ):
+  """Do a multiple sequence alignment of the reads in a family and their quality scores.
+  Returns a list of (name, aligned_seq, aligned_qual) tuples, one per read."""
   mate = str(mate)
   assert mate == '1' or mate == '2'
   if len(family) == 0:
     return None
-  elif len(family) == 1:
+  seqs = list(map(operator.attrgetter('seq'+mate), family))
+  if len(family) == 1:
     # If there's only one read pair, there's no alignment to be done (and MAFFT won't accept it).
-    aligned_seqs = [family[0]['seq'+mate]]
+    aligned_seqs = seqs
+  elif seqs.count(seqs[0]) == len(seqs):
+    # If all the reads are identical (common with PCR duplicates), the alignment is just the reads.
+    logging.debug(f'All {len(seqs)} reads identical. Skipping alignment.')
+    aligned_seqs = seqs
+  elif cache_msa:
+    aligned_seqs = make_msa_cached(
+      seqs, family, mate, aligner=aligner, aligner_path=aligner_path,
+      aligner_threads=aligner_threads
+    )
   else:
     # Do the multiple sequence alignment.
-    aligned_seqs = make_msa(family, mate, aligner=aligner)
+    aligned_seqs = make_msa(
+      family, mate, aligner=aligner, aligner_path=aligner_path, aligner_threads=aligner_threads
+    )
   # Transfer the alignment to the quality scores.
   ## Get a list of all quality scores in the family for this mate.
-  quals_raw = [pair['qual'+mate] for pair in family]
-  qual_alignment = seqtools.transfer_gaps_multi(quals_raw, aligned_seqs, gap_char_out=' ')
+  quals_raw = list(map(operator.attrgetter('qual'+mate), family))
+  qual_alignment = transfer_gaps_to_quals(quals_raw, aligned_seqs)
   # Package them up in the output data structure.
-  alignment = []
-  for pair, aligned_seq, aligned_qual in zip(family, aligned_seqs, qual_alignment):
-    alignment.append({'name':pair['name'+mate], 'seq':aligned_seq, 'qual':aligned_qual})
-  return alignment
+  names = map(operator.attrgetter('name'+mate), family)
+  return list(zip(names, aligned_seqs, qual_alignment))
+
+
+def transfer_gaps_to_quals(quals_raw, aligned_seqs):
+  """Insert gaps (as spaces) into the quality scores wherever they are in the aligned sequences.
+  Splitting an aligned sequence on its gaps gives the ungapped stretches between them. The quality
+  scores are cut into stretches of the same lengths, then joined back with a space for each gap.
+  Reads without gaps (single-read families, identical reads, etc) just keep their scores."""
+  assert len(quals_raw) == len(aligned_seqs), (
+    f'Unequal number of aligned sequences and quality score strings ({len(aligned_seqs)} vs '
+    f'{len(quals_raw)}, respectively)'
+  )
+  qual_alignment = []
+  for qual, seq in zip(quals_raw, aligned_seqs):
+    seq_len = len(seq) - seq.count(b'-')
+    assert len(qual) >= seq_len, (
+      f'Quality scores shorter than their read ({len(qual)} vs {seq_len} bases)'
+    )
+    if b'-' in seq:
+      pieces = []
+      add_piece = pieces.append
+      start = 0
+      for stretch in seq.split(b'-'):
+        end = start + len(stretch)
+        add_piece(qual[start:end])
+        start = end
+      qual = b' '.join(pieces)
+    else:
+      # Quality scores longer than the read get truncated to its length.
+      qual = qual[:len(seq)]
+    qual_alignment.append(qual)
+  return qual_alignment
+
+
+def make_msa_cached(seqs, family, mate, aligner='mafft', aligner_path=None, aligner_threads=1):
+  """Look up the alignment of these sequences in the cache, or do it with make_msa() and add it.
+  The key is a digest of the sequences in their original order, since the aligners' output follows
+  the input order. Storing the digest instead of the sequences themselves keeps the cache small.
+  The cache is a simple LRU: the least recently used entry is dropped once it's full."""
+  key = hashlib.blake2b(b'\n'.join(seqs), digest_size=16, person=aligner.encode()).digest()
+  # The lock is for --mate-threads, where several threads can use the cache at once.
+  with msa_cache_lock:
+    aligned_seqs = msa_cache.get(key)
+    if aligned_seqs is not None:
+      msa_cache.move_to_end(key)
+  if aligned_seqs is None:
+    aligned_seqs = make_msa(
+      family, mate, aligner=aligner, aligner_path=aligner_path, aligner_threads=aligner_threads
+    )
+    with msa_cache_lock:
+      msa_cache[key] = aligned_seqs
+      if len(msa_cache) > MSA_CACHE_SIZE:
+        msa_cache.popitem(last=False)
+  else:
+    logging.debug('Found family in alignment cache.')
+  return aligned_seqs
 
 
-def make_msa(family, mate, aligner='mafft'):
+def make_msa(family, mate, aligner='mafft', aligner_path=None, aligner_threads=1):
   if aligner == 'mafft':
-    return make_msa_mafft(family, mate)
+    return make_msa_mafft(family, mate, mafft_path=aligner_path, threads=aligner_threads)
   elif aligner == 'kalign':
     return make_msa_kalign(family, mate)
+  elif aligner == 'spoa':
+    return make_msa_spoa(family, mate)
   elif aligner == 'dummy':
     return make_msa_dummy(family, mate)
 
 
 def make_msa_dummy(family, mate):
   logging.info('Aligning with dummy.')
-  return [pair['seq'+mate] for pair in family]
+  return list(map(operator.attrgetter('seq'+mate), family))
 
 
 def make_msa_kalign(family, mate):
+  global kalign
   logging.info('Aligning with kalign.')
-  try:
-    # Import in the child process in case there's any issue in the .so with shared state between
-    # processes (maybe not possible, but just in case).
-    from kalign import kalign
-  except ImportError:
-    logging.critical('Error importing kalign module. Check that the submodule is installed properly.')
-    raise
-  seqs = [pair['seq'+mate] for pair in family]
+  if kalign is None:
+    try:
+      # Import in the child process in case there's any issue in the .so with shared state between
+      # processes (maybe not possible, but just in case). Only the first family in each process
+      # pays for the import; later ones reuse the cached module.
+      from kalign import kalign
+    except ImportError:
+      logging.critical('Error importing kalign module. Check that the submodule is installed properly.')
+      raise
+  seqs = [seq.decode() for seq in map(operator.attrgetter('seq'+mate), family)]
   aligned_seqs = kalign.align(seqs)
-  return aligned_seqs
+  return [seq.encode() for seq in aligned_seqs]
 
 
-def make_msa_mafft(family, mate):
-  """Perform a multiple sequence alignment on a set of sequences and parse the result.
-  Uses MAFFT."""
-  logging.info('Aligning with mafft.')
-  #TODO: Replace with tempfile.mkstemp()?
-  with tempfile.NamedTemporaryFile('w', delete=False, prefix='align.msa.') as family_file:
-    for pair in family:
-      name = pair['name'+mate]
-      seq = pair['seq'+mate]
-      family_file.write('>'+name+'\n')
-      family_file.write(seq+'\n')
-  with open(os.devnull, 'w') as devnull:
+def make_msa_spoa(family, mate):
+  """Align the family with a partial order alignment from spoa, without launching a process."""
+  global spoa_poa
+  logging.info('Aligning with spoa.')
+  if spoa_poa is None:
     try:
-      command = ['mafft', '--nuc', '--quiet', family_file.name]
-      output = subprocess.check_output(command, stderr=devnull)
-    except (OSError, subprocess.CalledProcessError):
+      from spoa import poa as spoa_poa
+    except ImportError:
+      logging.critical('Error importing spoa module. Check that pyspoa is installed.')
       raise
-    finally:
-      # Make sure we delete the temporary file.
-      os.remove(family_file.name)
-  return read_fasta(output)
+  seqs = [seq.decode() for seq in map(operator.attrgetter('seq'+mate), family)]
+  # algorithm=1 is a global (Needleman-Wunsch) alignment. The msa rows are in the input order.
+  consensus, msa = spoa_poa(seqs, algorithm=1, genmsa=True)
+  return [seq.upper().encode() for seq in msa]
+
+
+def make_msa_mafft(family, mate, mafft_path=None, threads=1):
+  """Perform a multiple sequence alignment on a set of sequences and parse the result.
+  Uses MAFFT. The sequences are fed to it through stdin, so no temporary file is needed.
+  If given, `mafft_path` should be the already-resolved path to the executable.
+  `threads` is passed to mafft's --thread option."""
+  logging.info('Aligning with mafft.')
+  get_name_and_seq = operator.attrgetter('name'+mate, 'seq'+mate)
+  fasta = b''.join([b'>'+name+b'\n'+seq+b'\n' for name, seq in map(get_name_and_seq, family)])
+  command = [mafft_path or 'mafft', '--nuc', '--quiet', '--thread', str(threads), '/dev/stdin']
+  # close_fds=False skips closing every possible file descriptor in the child on each launch.
+  result = subprocess.run(
+    command, input=fasta, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+    close_fds=False
+  )
+  return read_fasta(result.stdout)
 
 
 def read_fasta(fasta):
   """Quick and dirty FASTA parser. Return the sequences and their names.
-  Returns a list of sequences.
+  Takes the whole FASTA as bytes and returns a list of sequences (also bytes).
   Warning: Reads the entire contents of the file into memory at once."""
-  sequences = []
-  sequence = ''
-  for line in fasta.splitlines():
-    if line.startswith('>'):
-      if sequence:
-        sequences.append(sequence.upper())
-      sequence = ''
-      continue
-    sequence += line.strip()
-  if sequence:
-    sequences.append(sequence.upper())
-  return sequences
+  # Uppercase everything at once. The headers are thrown away anyway.
+  records = fasta.upper().lstrip(b'>').split(b'\n>')
+  sequences = [b''.join(record.partition(b'\n')[2].split()) for record in records]
+  return [sequence for sequence in sequences if sequence]
 
 
-def format_msa(align, barcode, order, mate, outfile=sys.stdout):
-  output = ''
-  for seq in align:
-    output += f'{barcode}\t{order}\t{mate}\t{seq["name"]}\t{seq["seq"]}\t{seq["qual"]}\n'
-  return output
+def format_msa(align, barcode, order, mate):
+  """Format the alignment as output lines (bytes, without line endings)."""
+  prefix = b'\t'.join((barcode, order, str(mate).encode()))
+  return [b'\t'.join((prefix, name, seq, qual)) for name, seq, qual in align]
 
 
-def process_result(result, stats):
+def process_result(result, stats, outfile):
   """Process the outcome of a duplex run.
-  Print the aligned output and sum the stats from the run with the running totals."""
-  output, run_stats = result
-  for key, value in run_stats.items():
-    stats[key] += value
+  Write the aligned output to `outfile` (a binary file) and sum the stats from the run with the
+  running totals."""
+  output, (pairs, run_time, runs, aligned_pairs, failures) = result
+  stats['pairs'] += pairs
+  stats['time'] += run_time
+  stats['runs'] += runs
+  stats['aligned_pairs'] += aligned_pairs
+  stats['failures'] += failures
   if output:
-    sys.stdout.write(output)
+    # The output is already encoded by the worker, so it goes straight to the binary file.
+    outfile.write(output)
 
 
 def tone_down_logger():
@@ -1,24 +1,34 @@
 #!/usr/bin/env python3
+import io
 import os
 import sys
 import gzip
 import time
+import typing
+import shutil
 import logging
 import argparse
 import resource
 import subprocess
+import collections
 import networkx
 import parallel_tools
 import shims
 from bfx import swalign
-from bfx import samreader
 from bfx import getreads
+try:
+  from isal import igzip
+except ImportError:
+  igzip = None
 # There can be problems with the submodules, but none are essential.
 # Try to load these modules, but if there's a problem, load a harmless dummy and continue.
 version = shims.get_module_or_shim('utillib.version')
 phone = shims.get_module_or_shim('ET.phone')
 
 VERBOSE = (logging.DEBUG+logging.INFO)//2
+GZIP_MAGIC = b'\x1f\x8b'
+OUTPUT_BATCH_LINES = 4096
+ORDER_FLIP = {'ab':'ba', 'ba':'ab'}
 USAGE = '$ %(prog)s [options] families.tsv barcodes.fa barcodes.sam > families.corrected.tsv'
 DESCRIPTION = """Correct barcodes using an alignment of all barcodes to themselves. Reads the
 alignment in SAM format and corrects the barcodes in an input "families" file (the output of
@@ -57,6 +67,10 @@ def make_argparser():
     help="Don't check to make sure read pairs have identical ids. By default, if this encounters a "
       "pair of reads in families.tsv with ids that aren't identical (minus an ending /1 or /2), it "
       "will throw an error.")
+  parser.add_argument('-B', '--families-buffer', type=int, default=32, metavar='MB',
+    help='If the (decompressed) families file is no bigger than this many megabytes, keep its '
+      'lines in memory after the first pass instead of reading (and maybe decompressing) it a '
+      'second time. Set to 0 to always re-read it. Default: %(default)s')
   parser.add_argument('--limit', type=int,
     help='Limit the number of entries that will be read from each input file, for testing purposes.')
   parser.add_argument('-S', '--structures', action='store_true',
@@ -124,17 +138,19 @@ def main(argv):
     passing_alignments = filter_alignment(
       args.sam, args.pos, args.mapq, args.dist, args.limit, args.allow_no_nm_if_ns
     )
-    graph, reversed_barcodes, num_good_alignments = read_alignments(
+    barcodes, edges, reversed_barcodes, num_good_alignments = read_alignments(
       passing_alignments, names_to_barcodes
     )
 
     logging.info('Reading the families.tsv to get the counts of each family..')
-    family_counts, read_pairs = get_family_counts(
-      args.families, limit=args.limit, check_ids=args.check_ids
+    family_counts, read_pairs, family_lines = get_family_counts(
+      args.families, limit=args.limit, check_ids=args.check_ids,
+      buffer_size=args.families_buffer*1024*1024
     )
 
     if args.structures or args.visualize != 0:
       logging.info('Counting the unique barcode networks..')
+      graph = make_graph(barcodes, edges)
       structures = count_structures(graph, family_counts)
       if args.structures:
         print_structures(structures, args.struct_human)
@@ -143,12 +159,19 @@ def main(argv):
         visualize([s['graph'] for s in structures], args.visualize, args.viz_format)
 
     logging.info('Building the correction table from the graph..')
-    corrections = make_correction_table(graph, family_counts, args.choose_by)
-
-    logging.info('Reading the families.tsv again to print corrected output..')
-    with open_as_text_or_gzip(args.families.name) as families:
+    corrections = make_correction_table(barcodes, edges, family_counts, args.choose_by)
+
+    if family_lines is None:
+      logging.info('Reading the families.tsv again to print corrected output..')
+      with open_as_text_or_gzip(args.families.name) as families:
+        print_corrected_output(
+          families, corrections, reversed_barcodes, args.prepend, args.limit, args.output
+        )
+    else:
+      logging.info('Printing corrected output..')
       print_corrected_output(
-        families, corrections, reversed_barcodes, args.prepend, args.limit, args.output
+        map(bytes.decode, family_lines), corrections, reversed_barcodes, args.prepend, args.limit,
+        args.output
       )
 
     run_time = int(time.time() - start_time)
@@ -191,9 +214,9 @@ def main(argv):
 
 def gather_prelim_data(families, reads, sam):
   data = {}
-  data['families_gzipped'] = isinstance(families, gzip.GzipFile)
+  data['families_gzipped'] = detect_gzip(families.name)
   data['families_size'] = os.path.getsize(families.name)
-  data['reads_gzipped'] = isinstance(reads, gzip.GzipFile)
+  data['reads_gzipped'] = detect_gzip(reads.name)
   data['reads_size'] = os.path.getsize(reads.name)
   data['sam_stdin'] = sam is sys.stdin
   if data['sam_stdin']:
@@ -207,9 +230,10 @@ def detect_format(reads_file, max_lines=7):
   """Detect whether a file is a fastq or a fasta, based on its content."""
   fasta_votes = 0
   fastq_votes = 0
-  line_num = 0
-  for line in reads_file:
-    line_num += 1
+  # Look at a single block from the start of the file instead of iterating over it, which would
+  # read (and maybe decompress) ahead more than we need.
+  lines = reads_file.read(8192).splitlines()
+  for line_num, line in enumerate(lines[:max_lines], 1):
     if line_num % 4 == 1:
       if line.startswith('@'):
         fastq_votes += 1
@@ -220,8 +244,6 @@ def detect_format(reads_file, max_lines=7):
         fastq_votes += 1
       elif line.startswith('>'):
         fasta_votes += 1
-    if line_num >= max_lines:
-      break
   reads_file.seek(0)
   if fasta_votes > fastq_votes:
     return 'fasta'
@@ -233,10 +255,16 @@ def detect_format(reads_file, max_lines=7):
 
 def read_fastaq(reads_file):
   filename = reads_file.name.lower()
+  if filename.endswith('.gz'):
+    filename = filename[:-3]
   if filename.endswith('.fa') or filename.endswith('.fasta'):
     format = 'fasta'
   elif filename.endswith('.fq') or filename.endswith('.fastq'):
     format = 'fastq'
+  elif isinstance(reads_file, PipedFile):
+    # We can't rewind a pipe, so sniff the start of the file through a separate handle.
+    with gzip.open(reads_file.name, 'rt') as sample_file:
+      format = detect_format(sample_file)
   else:
     format = detect_format(reads_file)
   return getreads.getparser(reads_file, filetype=format)
@@ -255,7 +283,9 @@ def map_names_to_barcodes(reads_file, limit=None):
     except ValueError:
       logging.critical(f'Non-int read name {read.name!r}')
       raise
-    names_to_barcodes[name] = read.seq
+    # Intern the barcodes so the many references to each one (in the graph, corrections, and
+    # family counts) share a single string, and dict lookups can short-circuit on identity.
+    names_to_barcodes[name] = sys.intern(read.seq)
   reads_file.close()
   return names_to_barcodes
 
@@ -265,17 +295,21 @@ def filter_alignment(
   ):
   """Read the SAM file and yield reads that pass the filters.
   Returns (qname, rname, reversed)."""
-  for aln_num, aln in enumerate(samreader.read(sam_file), 1):
+  # Check the log level once, so the per-alignment debug messages cost nothing (not even formatting
+  # the f-strings) when they won't be printed.
+  debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+  for aln_num, aln in enumerate(read_sam(sam_file), 1):
     if limit is not None and aln_num > limit:
       break
-    logging.debug(f'read {aln.rname} -> ref {aln.qname} (read seq {aln.seq}):')
+    if debug:
+      logging.debug(f'read {aln.rname} -> ref {aln.qname} (read seq {aln.seq}):')
     if aln.rname is None or aln.rname == '*':
-      logging.debug('\tRead unmapped (reference == "*")')
+      if debug:
+        logging.debug('\tRead unmapped (reference == "*")')
       continue
-    rname_fields = aln.rname.split(':')
-    if len(rname_fields) == 2 and rname_fields[1] == 'rev':
+    if aln.rname.endswith(':rev'):
       reversed = True
-      rname_str = rname_fields[0]
+      rname_str = aln.rname[:-4]
     else:
       reversed = False
       rname_str = aln.rname
@@ -288,22 +322,26 @@ def filter_alignment(
       )
       raise
     if qname == rname:
-      logging.debug('\tRead aligned to itself.')
+      if debug:
+        logging.debug('\tRead aligned to itself.')
       continue
     # Apply alignment quality filters.
     if aln.flag is None or aln.pos is None or aln.mapq is None:
       logging.warning(f'\tMissing flag ({aln.flag!r}), pos ({aln.pos!r}), or mapq ({aln.mapq!r})')
       continue
-    if aln.unmapped:
-      logging.debug('\tRead unmapped')
+    if aln.flag & 4:
+      if debug:
+        logging.debug('\tRead unmapped')
       continue
     if abs(aln.pos - 1) > pos_thres:
-      logging.debug(f'\tAlignment failed pos filter: abs({aln.pos} - 1) > {pos_thres}')
+      if debug:
+        logging.debug(f'\tAlignment failed pos filter: abs({aln.pos} - 1) > {pos_thres}')
       continue
     if aln.mapq < mapq_thres:
-      logging.debug(f'\tAlignment failed mapq filter: {aln.mapq} > {mapq_thres}')
+      if debug:
+        logging.debug(f'\tAlignment failed mapq filter: {aln.mapq} > {mapq_thres}')
       continue
-    nm = aln.tags.get('NM')
+    nm = aln.nm
     if nm is None:
       if 'N' in aln.seq:
         if allow_no_nm_if_ns:
@@ -312,23 +350,67 @@ def filter_alignment(
         else:
           raise RuntimeError(f'Alignment missing NM tag in alignment {aln_num}')
     if nm > dist_thres:
-      logging.debug(f'\tAlignment failed NM distance filter: {nm} > {dist_thres}')
+      if debug:
+        logging.debug(f'\tAlignment failed NM distance filter: {nm} > {dist_thres}')
       continue
     yield qname, rname, reversed
 
 
+class SamAlignment(typing.NamedTuple):
+  qname: str
+  flag: typing.Optional[int]
+  rname: typing.Optional[str]
+  pos: typing.Optional[int]
+  mapq: typing.Optional[int]
+  seq: str
+  nm: typing.Optional[int]
+
+
+def read_sam(sam_file):
+  """Parse only the SAM columns filter_alignment() needs.
+  This skips building a full alignment object (with every optional tag parsed) for each line."""
+  for line in sam_file:
+    if line.startswith('@'):
+      continue
+    fields = line.rstrip('\r\n').split('\t')
+    if len(fields) < 11:
+      continue
+    nm = None
+    for tag in fields[11:]:
+      if tag.startswith('NM:'):
+        nm = int_or_none(tag[5:])
+        break
+    rname = fields[2]
+    if rname == '*':
+      rname = None
+    yield SamAlignment(
+      fields[0], int_or_none(fields[1]), rname, int_or_none(fields[3]), int_or_none(fields[4]),
+      fields[9], nm
+    )
+
+
+def int_or_none(value):
+  try:
+    return int(value)
+  except ValueError:
+    return None
+
+
 def read_alignments(alignments, names_to_barcodes):
   """Read the alignments from the SAM file.
-  Returns (graph, reversed_barcodes, num_good_alignments):
-  graph: A networkx.Graph() containing a node per barcode (the sequence as a str), and an edge
-    between every pair of barcodes that align to each other (with a threshold-passing alignment).
+  Returns (barcodes, edges, reversed_barcodes, num_good_alignments):
+  barcodes: A list of every barcode (the sequence as a str) involved in a passing alignment. The
+    index of each barcode is its id in edges.
+  edges: A set() of (id1, id2) tuples, one for every pair of barcodes that align to each other
+    (with a threshold-passing alignment). The lower id always comes first, so each pair appears
+    only once.
   reversed_barcodes: The set() of all barcode sequences that are involved in an alignment where the
     target is reversed (swapped halves, like alpha+beta -> beta+alpha). Both the query and reference
     sequence in each alignment are marked here.
   num_good_alignments: The raw number of alignments processed that passed the filters."""
-  graph = networkx.Graph()
+  barcode_ids = {}
+  edges = set()
   reversed_barcodes = set()
-  # Maps correct barcode numbers to sets of original barcodes (includes correct ones).
   num_good_alignments = 0
   for qname, rname, reversed in alignments:
     num_good_alignments += 1
@@ -338,38 +420,84 @@ def read_alignments(alignments, names_to_barcodes):
     if reversed:
       reversed_barcodes.add(rseq)
       reversed_barcodes.add(qseq)
-    graph.add_node(rseq)
-    graph.add_node(qseq)
-    graph.add_edge(rseq, qseq)
-  return graph, reversed_barcodes, num_good_alignments
+    rid = barcode_ids.setdefault(rseq, len(barcode_ids))
+    qid = barcode_ids.setdefault(qseq, len(barcode_ids))
+    if rid < qid:
+      edges.add((rid, qid))
+    elif qid < rid:
+      edges.add((qid, rid))
+  return list(barcode_ids), edges, reversed_barcodes, num_good_alignments
+
+
+def make_graph(barcodes, edges):
+  """Build a networkx.Graph() with a node per barcode sequence, for the structure analyses."""
+  graph = networkx.Graph()
+  graph.add_edges_from((barcodes[id1], barcodes[id2]) for id1, id2 in edges)
+  return graph
+
 
+class FamilyCounts(typing.NamedTuple):
+  """The number of read pairs in each strand of a family, and in total.
+  A tuple takes much less memory than a dict, and there's one of these for every barcode."""
+  ab: int
+  ba: int
+  all: int
 
-def get_family_counts(families_file, limit=None, check_ids=True):
-  """For each family (barcode), count how many read pairs exist for each strand (order)."""
+
+def get_family_counts(families_file, limit=None, check_ids=True, buffer_size=0):
+  """For each family (barcode), count how many read pairs exist for each strand (order).
+  Also returns every line read (as bytes) in a list, as long as their total length stays within
+  buffer_size bytes. Otherwise, None is returned in its place."""
   family_counts = {}
   last_barcode = None
-  this_family_counts = None
+  ab = ba = 0
   read_pairs = 0
-  for line in families_file:
+  # Only split off as many columns as we need.
+  if check_ids:
+    max_split = 6
+  else:
+    max_split = 2
+  last_barcode_bytes = None
+  if buffer_size > 0:
+    saved_lines = []
+    saved_bytes = 0
+  else:
+    saved_lines = None
+  # Read the raw bytes underneath the text wrapper, so only the barcodes get decoded, and only once
+  # per family. (A gzip.GzipFile is already binary.)
+  for line in getattr(families_file, 'buffer', families_file):
     read_pairs += 1
     if limit is not None and read_pairs > limit:
       break
-    fields = line.rstrip('\r\n').split('\t')
+    if saved_lines is not None:
+      saved_bytes += len(line)
+      if saved_bytes > buffer_size:
+        # Too big to keep. The caller will read the file again instead.
+        saved_lines.clear()
+        saved_lines = None
+      else:
+        saved_lines.append(line)
+    fields = line.rstrip(b'\r\n').split(b'\t', max_split)
     if check_ids:
-      assert_read_ids_match(fields[2], fields[5])
-    barcode = fields[0]
+      assert_read_ids_match(fields[2].decode(), fields[5].decode())
+    barcode_bytes = fields[0]
     order = fields[1]
-    if barcode != last_barcode:
-      if this_family_counts:
-        this_family_counts['all'] = this_family_counts['ab'] + this_family_counts['ba']
-      family_counts[last_barcode] = this_family_counts
-      this_family_counts = {'ab':0, 'ba':0}
-      last_barcode = barcode
-    this_family_counts[order] += 1
-  this_family_counts['all'] = this_family_counts['ab'] + this_family_counts['ba']
-  family_counts[last_barcode] = this_family_counts
+    if barcode_bytes != last_barcode_bytes:
+      if last_barcode is not None:
+        family_counts[last_barcode] = FamilyCounts(ab, ba, ab+ba)
+      ab = ba = 0
+      last_barcode_bytes = barcode_bytes
+      last_barcode = sys.intern(barcode_bytes.decode())
+    if order == b'ab':
+      ab += 1
+    elif order == b'ba':
+      ba += 1
+    else:
+      raise ValueError(f'Invalid order {order.decode()!r} on line {read_pairs}.')
+  if last_barcode is not None:
+    family_counts[last_barcode] = FamilyCounts(ab, ba, ab+ba)
   families_file.close()
-  return family_counts, read_pairs
+  return family_counts, read_pairs, saved_lines
 
 
 def assert_read_ids_match(name1, name2):
@@ -390,28 +518,59 @@ def assert_read_ids_match(name1, name2):
     raise ValueError(f'Read names {name1!r} and {name2!r} do not match.')
 
 
-def make_correction_table(meta_graph, family_counts, choose_by='count'):
+def make_correction_table(barcodes, edges, family_counts, choose_by='count'):
   """Make a table mapping original barcode sequences to correct barcodes.
   Assumes the most connected node in the graph as the correct barcode."""
   corrections = {}
-  for nodes in networkx.connected_components(meta_graph):
-    graph = meta_graph.subgraph(nodes)
-    if choose_by == 'count':
-      def key(bar):
-        return family_counts[bar]['all']
-    elif choose_by == 'connect':
-      degrees = graph.degree()
-      def key(bar):
-        return degrees[bar]
-    barcodes = sorted(graph.nodes(), key=key, reverse=True)
-    correct = barcodes[0]
-    for barcode in barcodes:
-      if barcode != correct:
-        logging.debug(f'Correcting {barcode} ->\n           {correct}\n')
-        corrections[barcode] = correct
+  if choose_by == 'count':
+    def key(bar_id):
+      return family_counts[barcodes[bar_id]].all
+  elif choose_by == 'connect':
+    degrees = [0] * len(barcodes)
+    for id1, id2 in edges:
+      degrees[id1] += 1
+      degrees[id2] += 1
+    def key(bar_id):
+      return degrees[bar_id]
+  for bar_ids in get_components(len(barcodes), edges):
+    # Only the top barcode matters, so take the max instead of sorting the whole component.
+    correct_id = max(bar_ids, key=key)
+    correct = barcodes[correct_id]
+    for bar_id in bar_ids:
+      if bar_id == correct_id:
+        continue
+      barcode = barcodes[bar_id]
+      logging.debug(f'Correcting {barcode} ->\n           {correct}\n')
+      corrections[barcode] = correct
   return corrections
 
 
+def get_components(num_nodes, edges):
+  """Find the connected components of the graph with a union-find over the node ids.
+  Returns a list of components, each a list of node ids."""
+  parents = list(range(num_nodes))
+  sizes = [1] * num_nodes
+  def find(node):
+    # Path halving: point every other node on the way up at its grandparent.
+    while parents[node] != node:
+      parents[node] = node = parents[parents[node]]
+    return node
+  for id1, id2 in edges:
+    root1 = find(id1)
+    root2 = find(id2)
+    if root1 == root2:
+      continue
+    # Union by size, to keep the trees shallow.
+    if sizes[root1] < sizes[root2]:
+      root1, root2 = root2, root1
+    parents[root2] = root1
+    sizes[root1] += sizes[root2]
+  components = {}
+  for node in range(num_nodes):
+    components.setdefault(find(node), []).append(node)
+  return list(components.values())
+
+
 def print_corrected_output(
     families_file, corrections, reversed_barcodes, prepend=False, limit=None, output=True
   ):
@@ -421,11 +580,25 @@ def print_corrected_output(
   corrected = {'reads':0, 'barcodes':0, 'reversed':0}
   reads = [0, 0]
   corrections_in_this_family = 0
+  output_lines = []
+  # Map each raw barcode to its correct barcode and whether the correction reverses its order.
+  # That only depends on the two barcodes, so work it out up front and the loop over read pairs only
+  # needs one dict lookup. First, we check in reversed_barcodes whether either barcode was involved
+  # in a reversed alignment, to save time (is_alignment_reversed() does a full smith-waterman
+  # alignment).
+  corrected_barcodes = {}
+  for raw_barcode, correct_barcode in corrections.items():
+    reverses = (
+      (raw_barcode in reversed_barcodes or correct_barcode in reversed_barcodes) and
+      is_alignment_reversed(raw_barcode, correct_barcode)
+    )
+    corrected_barcodes[raw_barcode] = (correct_barcode, reverses)
   for line in families_file:
     line_num += 1
     if limit is not None and line_num > limit:
       break
-    fields = line.rstrip('\r\n').split('\t')
+    # Only the barcode and order are touched, so leave the rest of the line in one piece.
+    fields = line.rstrip('\r\n').split('\t', 2)
     raw_barcode = fields[0]
     order = fields[1]
     if raw_barcode != barcode_last:
@@ -446,25 +619,19 @@ def print_corrected_output(
       reads[0] += 1
     elif order == 'ba':
       reads[1] += 1
-    if raw_barcode in corrections:
-      correct_barcode = corrections[raw_barcode]
+    correction = corrected_barcodes.get(raw_barcode)
+    if correction is None:
+      correct_barcode = raw_barcode
+      correct_order = order
+    else:
+      correct_barcode, reverses = correction
       corrections_in_this_family += 1
-      # Check if the order of the barcode reverses in the correct version.
-      # First, we check in reversed_barcodes whether either barcode was involved in a reversed
-      # alignment, to save time (is_alignment_reversed() does a full smith-waterman alignment).
-      if ((raw_barcode in reversed_barcodes or correct_barcode in reversed_barcodes) and
-          is_alignment_reversed(raw_barcode, correct_barcode)):
-        # If so, then switch the order field.
+      # If the order of the barcode reverses in the correct version, switch the order field.
+      if reverses:
         corrected['reversed'] += 1
-        if order == 'ab':
-          correct_order = 'ba'
-        else:
-          correct_order = 'ab'
+        correct_order = ORDER_FLIP.get(order, 'ab')
       else:
         correct_order = order
-    else:
-      correct_barcode = raw_barcode
-      correct_order = order
     # Add the corrected barcode and order to the output.
     if prepend:
       fields.insert(0, correct_barcode)
@@ -473,7 +640,14 @@ def print_corrected_output(
       fields[0] = correct_barcode
       fields[1] = correct_order
     if output:
-      print(*fields, sep='\t')
+      output_lines.append('\t'.join(fields))
+      if len(output_lines) >= OUTPUT_BATCH_LINES:
+        output_lines.append('')
+        sys.stdout.write('\n'.join(output_lines))
+        output_lines.clear()
+  if output_lines:
+    output_lines.append('')
+    sys.stdout.write('\n'.join(output_lines))
   if corrections_in_this_family:
     corrected['reads'] += corrections_in_this_family
     corrected['barcodes'] += 1
@@ -502,83 +676,94 @@ def is_alignment_reversed(barcode1, barcode2):
 def count_structures(meta_graph, family_counts):
   """Count the number of unique (isomorphic) subgraphs in the main graph."""
   structures = []
+  # Isomorphic graphs always have the same degree sequence (and so the same numbers of nodes and
+  # edges), so group the structures by that and only run the expensive isomorphism test within a
+  # group.
+  structures_by_degrees = collections.defaultdict(list)
   for nodes in networkx.connected_components(meta_graph):
-    graph = meta_graph.subgraph(nodes)
-    match = False
-    for structure in structures:
-      archetype = structure['graph']
-      if networkx.is_isomorphic(graph, archetype):
-        match = True
-        structure['count'] += 1
-        structure['central'] += int(is_centralized(graph, family_counts))
-        break
-    if not match:
-      size = len(graph)
-      central = is_centralized(graph, family_counts)
-      structures.append({'graph':graph, 'size':size, 'count':1, 'central':int(central)})
+    # A component's degrees in the full graph are the same as in its subgraph, so we can get them
+    # without building a subgraph view.
+    degrees = dict(meta_graph.degree(nodes))
+    degree_seq = tuple(sorted(degrees.values(), reverse=True))
+    candidates = structures_by_degrees[degree_seq]
+    central = is_centralized(degrees, family_counts)
+    match = None
+    if candidates and len(degrees) <= 4:
+      # Connected graphs of up to 4 nodes are fully determined by their degree sequence, so no
+      # isomorphism test (or subgraph) is needed for these small, common cases.
+      match = candidates[0]
+    else:
+      graph = meta_graph.subgraph(nodes)
+      for structure in candidates:
+        if networkx.is_isomorphic(graph, structure['graph']):
+          match = structure
+          break
+    if match:
+      match['count'] += 1
+      match['central'] += int(central)
+    else:
+      structure = {
+        'graph':graph, 'size':len(degrees), 'count':1, 'central':int(central), 'degrees':degree_seq
+      }
+      structures.append(structure)
+      candidates.append(structure)
   return structures
 
 
-def is_centralized(graph, family_counts):
+def is_centralized(degrees, family_counts):
   """Checks if the graph is centralized in terms of where the reads are located.
   In a centralized graph, the node with the highest degree is the only one which (may) have more
   than one read pair associated with that barcode.
+  The graph is given as a dict mapping each of its nodes to its degree.
   This returns True if that's the case, False otherwise."""
-  if len(graph) == 2:
+  if len(degrees) == 2:
     # Special-case graphs with 2 nodes, since the other algorithm doesn't work for them.
     # - When both nodes have a degree of 1, sorting by degree doesn't work and can result in the
     #   barcode with more read pairs coming second.
-    barcode1, barcode2 = graph.nodes()
+    barcode1, barcode2 = degrees
     counts1 = family_counts[barcode1]
     counts2 = family_counts[barcode2]
-    total1 = counts1['all']
-    total2 = counts2['all']
+    total1 = counts1.all
+    total2 = counts2.all
     logging.debug(
-      f'{barcode1}: {total1:3d} ({counts1["ab"]}/{counts1["ba"]})\n'
-      f'{barcode2}: {total2:3d} ({counts2["ab"]}/{counts2["ba"]})'
+      f'{barcode1}: {total1:3d} ({counts1.ab}/{counts1.ba})\n'
+      f'{barcode2}: {total2:3d} ({counts2.ab}/{counts2.ba})'
     )
     if (total1 >= 1 and total2 == 1) or (total1 == 1 and total2 >= 1):
       return True
     else:
       return False
   else:
-    degrees = graph.degree()
-    first = True
-    for barcode in sorted(graph.nodes(), key=lambda barcode: degrees[barcode], reverse=True):
-      if not first:
-        counts = family_counts[barcode]
-        # How many read pairs are associated with this barcode (how many times did we see this barcode)?
-        try:
-          if counts['all'] > 1:
-            return False
-        except TypeError:
-          logging.critical(f'barcode: {barcode}, counts: {counts}')
-          raise
-      first = False
+    # Find the node with the highest degree in one pass instead of sorting them all.
+    hub = max(degrees, key=degrees.get)
+    for barcode in degrees:
+      if barcode == hub:
+        continue
+      counts = family_counts[barcode]
+      # How many read pairs are associated with this barcode (how many times did we see this barcode)?
+      try:
+        if counts.all > 1:
+          return False
+      except TypeError:
+        logging.critical(f'barcode: {barcode}, counts: {counts}')
+        raise
     return True
 
 
 def print_structures(structures, human=True):
-  # Define a cmp function to sort the list of structures in ascending order of size, but then
-  # descending order of count.
-  def cmp_fxn(structure1, structure2):
-    if structure1['size'] == structure2['size']:
-      return structure2['count'] - structure1['count']
-    else:
-      return structure1['size'] - structure2['size']
-  width = None
+  if not structures:
+    return
+  width = str(len(str(max(structure['count'] for structure in structures))))
   last_size = None
-  for structure in sorted(structures, cmp=cmp_fxn):
+  # Sort the structures in ascending order of size, but then descending order of count.
+  for structure in sorted(structures, key=lambda s: (s['size'], -s['count'])):
     size = structure['size']
-    graph = structure['graph']
     if size == last_size:
       i += 1
     else:
       i = 0
-    if width is None:
-      width = str(len(str(structure['count'])))
     letters = num_to_letters(i)
-    degrees = sorted(graph.degree().values(), reverse=True)
+    degrees = structure['degrees']
     if human:
       degrees_str = ' '.join(map(str, degrees))
     else:
@@ -593,40 +778,36 @@ def print_structures(structures, human=True):
 
 def num_to_letters(i):
   """Translate numbers to letters, e.g. 1 -> A, 10 -> J, 100 -> CV"""
-  letters = ''
+  letters = []
   while i > 0:
-    n = (i-1) % 26
-    i = i // 26
-    if n == 25:
-      i -= 1
-    letters = chr(65+n) + letters
-  return letters
+    i, n = divmod(i-1, 26)
+    letters.append(chr(65+n))
+  return ''.join(reversed(letters))
 
 
 def visualize(graphs, viz_path, args_viz_format):
-  import matplotlib
-  from networkx.drawing.nx_agraph import graphviz_layout
   meta_graph = networkx.Graph()
   for graph in graphs:
     add_graph(meta_graph, graph)
-  pos = graphviz_layout(meta_graph)
-  networkx.draw(meta_graph, pos)
+  viz_format = args_viz_format
   if viz_path:
-    ext = os.path.splitext(viz_path)[1]
+    base_path, ext = os.path.splitext(viz_path)
     if ext == '.dot':
       viz_format = 'graphviz'
     elif ext == '.png':
       viz_format = 'png'
-  else:
-    viz_format = args_viz_format
-  if viz_format == 'graphviz':
+  if viz_format in ('dot', 'graphviz'):
     from networkx.drawing.nx_pydot import write_dot
     assert viz_path is not None, 'Must provide a filename to --visualize if using --viz-format "graphviz".'
-    base_path = os.path.splitext(viz_path)
     write_dot(meta_graph, base_path+'.dot')
     run_command('dot', '-T', 'png', '-o', base_path+'.png', base_path+'.dot')
     logging.info('Wrote image of graph to '+base_path+'.dot')
   elif viz_format == 'png':
+    # Only the matplotlib output needs a layout computed here (dot does its own).
+    import matplotlib.pyplot
+    from networkx.drawing.nx_agraph import graphviz_layout
+    pos = graphviz_layout(meta_graph)
+    networkx.draw(meta_graph, pos)
     if viz_path is None:
       matplotlib.pyplot.show()
     else:
@@ -644,36 +825,55 @@ def add_graph(graph, subgraph):
 
 def open_as_text_or_gzip(path):
   """Return an open file-like object reading the path as a text file or a gzip file, depending on
-  which it looks like."""
+  which it looks like.
+  If pigz is available, gzip files are decompressed by it in a separate process, so decompression
+  runs in parallel with our parsing. Otherwise, use ISA-L's faster igzip module if it's
+  installed."""
   if detect_gzip(path):
-    return gzip.open(path, 'r')
+    pigz_path = shutil.which('pigz')
+    if pigz_path:
+      process = subprocess.Popen((pigz_path, '-dc', path), stdout=subprocess.PIPE)
+      return PipedFile(process, path)
+    elif igzip:
+      return igzip.open(path, 'rt')
+    else:
+      return gzip.open(path, 'rt')
   else:
     return open(path, 'r')
 
 
+class PipedFile(io.TextIOWrapper):
+  """A text file reading the output of a decompression process.
+  Its .name is the path of the original file, like the file objects gzip.open() returns."""
+
+  def __init__(self, process, path):
+    super().__init__(process.stdout)
+    self.process = process
+    self.path = path
+
+  @property
+  def name(self):
+    return self.path
+
+  def close(self):
+    if self.closed:
+      return
+    super().close()
+    # A negative return code just means it was killed by SIGPIPE because we stopped reading early.
+    if self.process.wait() > 0:
+      raise subprocess.CalledProcessError(self.process.returncode, self.process.args)
+
+
 def detect_gzip(path):
-  """Return True if the file looks like a gzip file: ends with .gz or contains non-ASCII bytes."""
+  """Return True if the file looks like a gzip file: ends with .gz or starts with the gzip magic
+  number."""
   ext = os.path.splitext(path)[1]
   if ext == '.gz':
     return True
   elif ext in ('.txt', '.tsv', '.csv'):
     return False
-  with open(path) as fh:
-    is_not_ascii = detect_non_ascii(fh.read(100))
-  if is_not_ascii:
-    return True
-
-
-def detect_non_ascii(bytes, max_test=100):
-  """Return True if any of the first "max_test" bytes are non-ASCII (the high bit set to 1).
-  Return False otherwise."""
-  for i, char in enumerate(bytes):
-    # Is the high bit a 1?
-    if ord(char) & 128:
-      return True
-    if i >= max_test:
-      return False
-  return False
+  with open(path, 'rb') as fh:
+    return fh.read(2) == GZIP_MAGIC
 
 
 def run_command(*command):
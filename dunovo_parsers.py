@@ -83,77 +83,89 @@ class DunovoFormatError(ValueError):
   pass
 
 
+# The StrandFamily attribute names for each mate, and the other order for each order, so the parsers
+# don't have to build or branch on these for every line.
+MATE_ATTRS = {1:'mate1', 2:'mate2'}
+OTHER_ORDERS = {'ab':'ba', 'ba':'ab'}
+# These are immutable, so every BarFamily missing a strand can share the same empty one.
+EMPTY_STRAND_FAMILIES = {
+  'ab':StrandFamily('ab', ReadFamily(1,()), ReadFamily(2,())),
+  'ba':StrandFamily('ba', ReadFamily(1,()), ReadFamily(2,())),
+}
+
+
 def parse_make_families(lines, prepended=False):
-  strand_families = []
-  strand_family_lines = []
+  # The finished StrandFamilies for the current barcode, keyed by order.
+  strand_families = {}
+  read1s = []
+  read2s = []
   last_barcode = last_order = None
   if prepended:
     expected_columns = 10
   else:
     expected_columns = 8
-  for line_num, line in enumerate(lines, 1):
+  line_num = 0
+  for line in lines:
+    line_num += 1
     fields = line.rstrip('\r\n').split('\t')
     if len(fields) != expected_columns:
       raise DunovoFormatError(f'Line {line_num} has an invalid number of columns: {len(fields)}')
-    # If it's the output of correct.py with --prepend, there's an extra column.
-    # We want the corrected barcode (column 1), not the original one (column 2).
+    # If it's the output of correct.py with --prepend, there are two extra columns.
+    # We want the corrected barcode and order (columns 1 and 2), not the original ones (3 and 4).
     if prepended:
-      fields[2:4] = []
-    barcode, order = fields[:2]
+      barcode, order, _, _, name1, seq1, quals1, name2, seq2, quals2 = fields
+    else:
+      barcode, order, name1, seq1, quals1, name2, seq2, quals2 = fields
     if barcode != last_barcode or order != last_order:
       if last_order is not None:
-        strand_families.append(create_strand_family(strand_family_lines))
-      strand_family_lines = []
+        add_strand_family(strand_families, read1s, read2s, last_barcode, last_order)
+      # The families copy what they need from these lists, so we can reuse them.
+      read1s.clear()
+      read2s.clear()
     if barcode != last_barcode:
       if last_barcode is not None:
         yield create_bar_family(strand_families, last_barcode)
-      strand_families = []
-    strand_family_lines.append(fields)
+      strand_families.clear()
+    # Build the reads right away instead of storing the fields for a second pass.
+    read1s.append(Read(name=name1, seq=seq1, qual=quals1))
+    read2s.append(Read(name=name2, seq=seq2, qual=quals2))
     last_barcode = barcode
     last_order = order
   if last_order is not None:
-    strand_families.append(create_strand_family(strand_family_lines))
+    add_strand_family(strand_families, read1s, read2s, last_barcode, last_order)
   if last_barcode is not None:
     yield create_bar_family(strand_families, last_barcode)
 
 
-def create_strand_family(strand_family_lines):
-  read1s = []
-  read2s = []
-  last_order = None
-  for fields in strand_family_lines:
-    barcode, order, name1, seq1, quals1, name2, seq2, quals2 = fields
-    if order not in ('ab', 'ba'):
-      raise DunovoFormatError(f'Invalid order: {order!r}')
-    assert order == last_order or last_order is None, (order, last_order)
-    read1s.append(Read(name=name1, seq=seq1, qual=quals1))
-    read2s.append(Read(name=name2, seq=seq2, qual=quals2))
-    last_order = order
+def create_strand_family(read1s, read2s, order):
+  if order not in ('ab', 'ba'):
+    raise DunovoFormatError(f'Invalid order: {order!r}')
   read_family1 = ReadFamily(1, tuple(read1s))
   read_family2 = ReadFamily(2, tuple(read2s))
   return StrandFamily(order, read_family1, read_family2)
 
 
-def create_bar_family(strand_families_raw, barcode):
-  assert 1 <= len(strand_families_raw) <= 2, len(strand_families_raw)
-  # Create a strand_families list with them in the right order.
-  strand_families = [None, None]
-  for strand_family in strand_families_raw:
-    if strand_family.order == 'ab':
-      strand_families[0] = strand_family
-    elif strand_family.order == 'ba':
-      strand_families[1] = strand_family
+def add_strand_family(strand_families, read1s, read2s, barcode, order):
+  if order in strand_families:
+    raise DunovoFormatError(
+      f'Reads for barcode {barcode!r} and order {order!r} are not all together. Is the input sorted?'
+    )
+  strand_families[order] = create_strand_family(read1s, read2s, order)
+
+
+def create_bar_family(strand_families, barcode):
   # Fill in any missing strand families with empty ones.
-  for i, (order, strand_family) in enumerate(zip(('ab', 'ba'), strand_families)):
-    if strand_family is None:
-      strand_families[i] = StrandFamily(order, ReadFamily(1,()), ReadFamily(2,()))
-  return BarFamily(barcode, *strand_families)
+  ab = strand_families.get('ab', EMPTY_STRAND_FAMILIES['ab'])
+  ba = strand_families.get('ba', EMPTY_STRAND_FAMILIES['ba'])
+  return BarFamily(barcode, ab, ba)
 
 
 def parse_msa(lines):
   bar_family = strand_family = read_family = None
   last_mate = last_order = last_bar = None
-  for line_num, line in enumerate(lines,1):
+  line_num = 0
+  for line in lines:
+    line_num += 1
     # Parse the values from the line.
     fields = line.rstrip('\r\n').split('\t')
     if len(fields) != 6:
@@ -161,9 +173,11 @@ def parse_msa(lines):
     barcode, order, mate_str, name, seq, quals = fields
     try:
       mate = int(mate_str)
-    except ValueError:
+      mate_attr = MATE_ATTRS[mate]
+    except (ValueError, KeyError):
       raise DunovoFormatError(f'Line {line_num} has an invalid mate column: {mate_str!r}') from None
-    print(f'Parsed line {line_num}: {barcode} {order} {mate}')
+    if order not in OTHER_ORDERS:
+      raise DunovoFormatError(f'Line {line_num} has an invalid order column: {order!r}')
     # Reset any families if we've started a new one, and yield the BarFamily if we've finished one.
     if barcode != last_bar:
       if bar_family:
@@ -173,30 +187,29 @@ def parse_msa(lines):
       read_family = strand_family = None
     if mate != last_mate:
       read_family = None
-    # Find the right families for this line, if they exist.
-    if bar_family is not None:
+    # Find the right families for this line, if they exist. Any family still set is the same one the
+    # last line was in, so we only need to look up the ones that were just reset.
+    if strand_family is None and bar_family is not None:
       strand_family = getattr(bar_family, order)
-    if strand_family is not None:
-      read_family = getattr(strand_family, f'mate{mate}')
-    # Create any families that don't exist yet.
+    if read_family is None and strand_family is not None:
+      read_family = getattr(strand_family, mate_attr)
+    # Create any families that don't exist yet, and nest them in their parent families.
+    # Existing families don't need to be rebuilt, since reads are appended to their lists in place.
     if read_family is None:
-      print('  read_family was None. Creating.')
       read_family = ReadFamily(mate=mate, reads=[])
+      if strand_family is not None:
+        strand_family = strand_family._replace(**{mate_attr:read_family})
+        bar_family = bar_family._replace(**{order:strand_family})
     if strand_family is None:
-      print('  strand_family was None. Creating.')
-      attrs = {'order':order, f'mate{mate}':read_family, f'mate{other_mate(mate)}':None}
+      attrs = {'order':order, mate_attr:read_family, MATE_ATTRS[3-mate]:None}
       strand_family = StrandFamily(**attrs)
+      if bar_family is not None:
+        bar_family = bar_family._replace(**{order:strand_family})
     if bar_family is None:
-      print('  bar_family was None. Creating.')
-      attrs = {'bar':barcode, order:strand_family, other_order(order):None}
+      attrs = {'bar':barcode, order:strand_family, OTHER_ORDERS[order]:None}
       bar_family = BarFamily(**attrs)
-    # Add the read to the ReadFamily and properly nest the families.
-    read = Read(name=name, seq=seq, qual=quals)
-    read_family.reads.append(read)
-    attrs = {f'mate{mate}':read_family}
-    strand_family = strand_family._replace(**attrs)
-    attrs = {order:strand_family}
-    bar_family = bar_family._replace(**attrs)
+    # Add the read to the ReadFamily.
+    read_family.reads.append(Read(name=name, seq=seq, qual=quals))
     # Set the last values to the current values.
     last_bar = barcode
     last_order = order
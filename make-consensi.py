@@ -14,14 +14,29 @@ try:
   from bfx import pair_align
 except ImportError:
   pair_align = None
+try:
+  import parasail
+except ImportError:
+  parasail = None
+try:
+  import edlib
+except ImportError:
+  edlib = None
 # There can be problems with the submodules, but none are essential.
 # Try to load these modules, but if there's a problem, load a harmless dummy and continue.
 simplewrap = shims.get_module_or_shim('utillib.simplewrap')
 version = shims.get_module_or_shim('utillib.version')
 phone = shims.get_module_or_shim('ET.phone')
 
+# How many bytes of input to read at once.
+INPUT_BUFFER_SIZE = 1024*1024
 # The ascii values that represent a 0 PHRED score.
 QUAL_OFFSETS = {'sanger':33, 'solexa':64}
+# Gap penalties for --aligner parasail (used with its DNAfull substitution matrix).
+PARASAIL_GAP_OPEN = 10
+PARASAIL_GAP_EXTEND = 1
+# Holds the two aligned (gapped) sequences, like the alignment objects from swalign and pair_align.
+Alignment = collections.namedtuple('Alignment', ('target', 'query'))
 USAGE = """$ %(prog)s [options] families.msa.tsv -1 duplexes_1.fa -2 duplexes_2.fa
        $ cat families.msa.tsv | %(prog)s [options] -1 duplexes_1.fa -2 duplexes_2.fa"""
 DESCRIPTION = """Build consensus sequences from read aligned families. Prints duplex consensus \
@@ -52,7 +67,7 @@ def make_argparser():
   wrapper.width = wrapper.width - 24
   io = parser.add_argument_group('Inputs and outputs')
   io.add_argument('infile', metavar='families.msa.tsv', nargs='?', default=sys.stdin,
-    type=argparse.FileType('r'),
+    type=argparse.FileType('r', bufsize=INPUT_BUFFER_SIZE),
     help=wrap('The output of align_families.py. 6 columns:\n'
               '1. (canonical) barcode\n'
               '2. order ("ab" or "ba")\n'
@@ -94,11 +109,15 @@ def make_argparser():
     help=wrap('The absolute threshold to use when making consensus sequences. The consensus base '
               'must be present in more than this number of reads, or N will be used as the '
               'consensus base instead. Default: %(default)s'))
-  params.add_argument('-a', '--aligner', choices=('swalign', 'biopython'), default='biopython',
+  params.add_argument('-a', '--aligner', choices=ALIGNERS.keys(), default='biopython',
     help=wrap("Which pairwise alignment library to use. 'swalign' uses a custom Smith-Waterman "
               "implementation by Nicolaus Lance Hepler and is the old default. 'biopython' uses "
               "BioPython's PairwiseAligner and a substitution matrix built by the Bioconductor's "
-              'Biostrings package. Default: %(default)s'))
+              "Biostrings package. 'parasail' uses the SIMD-vectorized (striped) Smith-Waterman "
+              "from the parasail library, which is much faster. 'edlib' uses edlib's bit-parallel "
+              'global alignment, which is fastest when the two strands differ at only a few '
+              'bases. It scores by edit distance and trims gaps off the ends of the alignment. '
+              'Default: %(default)s'))
   phoning = parser.add_argument_group('Feedback')
   phoning.add_argument('--phone-home', action='store_true',
     help=wrap('Report helpful usage data to the developer, to better understand the use cases and '
@@ -131,6 +150,15 @@ def make_argparser():
     help=wrap('How long to go accumulating responses from worker subprocesses before dealing '
               f'with all of them. Default: {parallel_tools.QUEUE_SIZE_MULTIPLIER} * the number of '
               'worker --processes.'))
+  misc.add_argument('--queue-mem', metavar='MB', type=float, default=256,
+    help=wrap('Also deal with the responses from the workers once the duplexes waiting on them add '
+              'up to this many megabytes of input data. This keeps very large families from '
+              'piling up in memory. The actual memory used per duplex is a few times larger than '
+              'its input. Default: %(default)s'))
+  misc.add_argument('--duplex-batch', type=int, default=16,
+    help=wrap('How many duplexes to send to a worker process at once. Batching saves on the '
+              'overhead of communicating with the workers, which adds up over the many small '
+              'duplexes in a typical run. Default: %(default)s'))
   misc.add_argument('-v', '--version', action='version', version=str(version.get_version()),
     help=wrap('Print the version number and exit.'))
   misc.add_argument('-h', '--help', action='help',
@@ -171,6 +199,10 @@ def main(argv):
     # Process and validate arguments.
     if args.queue_size is not None and args.queue_size <= 0:
       fail('Error: --queue-size must be greater than zero.')
+    if args.queue_mem <= 0:
+      fail('Error: --queue-mem must be greater than zero.')
+    if args.duplex_batch <= 0:
+      fail('Error: --duplex-batch must be greater than zero.')
     qual_start = QUAL_OFFSETS[args.qual_format]
     qual_thres = chr(args.qual + qual_start)
     if args.fastq_out is None:
@@ -192,6 +224,16 @@ def main(argv):
         'Error: Could not import pair_align module. Make sure BioPython is installed if you want '
         "to use the 'biopython' --aligner."
       )
+    if args.aligner == 'parasail' and parasail is None:
+      fail(
+        "Error: Could not import parasail. Make sure it's installed if you want to use the "
+        "'parasail' --aligner."
+      )
+    if args.aligner == 'edlib' and edlib is None:
+      fail(
+        "Error: Could not import edlib. Make sure it's installed if you want to use the 'edlib' "
+        '--aligner.'
+      )
     if not any((args.dcs1, args.dcs2, args.sscs1, args.sscs2)):
       parser.print_usage()
       fail('Error: must specify an output file!')
@@ -208,6 +250,7 @@ def main(argv):
     pool = parallel_tools.SyncAsyncPool(
       process_duplex, processes=args.processes, static_kwargs=static_kwargs,
       queue_size=args.queue_size, callback=process_result, callback_args=[filehandles, stats],
+      max_queue_cost=int(args.queue_mem*1024*1024), batch_size=args.duplex_batch
     )
     try:
       process_families(args.infile, pool, stats)
@@ -268,12 +311,15 @@ def main(argv):
 
 def process_families(infile, pool, stats):
   total_reads = 0
-  duplex = collections.OrderedDict()
+  duplex = {}
+  # The size of the input lines for the current duplex, to tell the pool how much it holds.
+  duplex_bytes = 0
   family = []
   barcode = None
   order = None
   # Note: mate is a 0-indexed integer ("mate 1" from the input file is mate 0 here).
   mate = None
+  mate_str = None
   for line in infile:
     # Allow comments (e.g. for test input files).
     if line.startswith('#'):
@@ -282,13 +328,13 @@ def process_families(infile, pool, stats):
     if len(fields) != 6:
       continue
     this_barcode, this_order, this_mate_str, name, seq, qual = fields
-    this_mate = int(this_mate_str)-1
     # If the barcode, order, and mate are the same, we're just continuing the add reads to the
     # current family. Otherwise, store the current family, start a new one, and process the
     # duplex if we're at the end of one.
     new_barcode = this_barcode != barcode
     new_order = this_order != order
-    new_mate = this_mate != mate
+    # Compare the raw mate strings, so the int conversion only happens once per family.
+    new_mate = this_mate_str != mate_str
     if new_barcode or new_order or new_mate:
       if order is not None and mate is not None:
         duplex[(order, mate)] = family
@@ -296,14 +342,17 @@ def process_families(infile, pool, stats):
       if new_barcode and barcode is not None:
         assert len(duplex) <= 4, duplex.keys()
         pool.compute(duplex, barcode)
+        pool.add_cost(duplex_bytes)
         stats['duplexes'] += 1
-        duplex = collections.OrderedDict()
+        duplex = {}
+        duplex_bytes = 0
       barcode = this_barcode
       order = this_order
-      mate = this_mate
+      mate = int(this_mate_str)-1
+      mate_str = this_mate_str
       family = []
-    read = {'name': name, 'seq':seq, 'qual':qual}
-    family.append(read)
+    family.append((name, seq, qual))
+    duplex_bytes += len(line)
     total_reads += 1
   # Process the last family.
   if order is not None and mate is not None:
@@ -343,8 +392,9 @@ def process_duplex(
   # The code in the main loop used to ensure that "duplex" contains only reads belonging to one final
   # duplex consensus read: ab.1 and ba.2 reads OR ab.2 and ba.1 reads. (Of course, one half might
   # be missing).
-  famsizes = ', '.join([str(len(family)) for family in duplex.values()])
-  logging.info(f'Starting duplex {barcode}: {famsizes}')
+  if logging.getLogger().isEnabledFor(logging.INFO):
+    famsizes = ', '.join([str(len(family)) for family in duplex.values()])
+    logging.info(f'Starting duplex {barcode}: {famsizes}')
   start = time.time()
   # Construct consensus sequences.
   try:
@@ -358,7 +408,8 @@ def process_duplex(
   # Calculate run statistics.
   elapsed = time.time() - start
   total_reads = sum([len(family) for family in duplex.values()])
-  logging.debug(f'{elapsed} sec for {total_reads} reads.')
+  if logging.getLogger().isEnabledFor(logging.DEBUG):
+    logging.debug(f'{elapsed} sec for {total_reads} reads.')
   if len(sscss) > 0:
     run_stats = {'time':elapsed, 'runs':1, 'reads':total_reads}
   else:
@@ -371,10 +422,11 @@ def make_sscss(duplex, min_reads, cons_thres, min_cons_reads, qual_thres):
   sscss = {}
   for (order, mate), family in duplex.items():
     # logging.info(f'\t{order}.{mate}:')
-    # for read in family:
-    #   logging.info('\t\t{name}\t{seq}'.format(**read))
+    # for name, seq, qual in family:
+    #   logging.info(f'\t\t{name}\t{seq}')
     if len(family) < min_reads:
-      logging.debug(f'\tnot enough reads ({len(family)} < {min_reads})')
+      if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f'\tnot enough reads ({len(family)} < {min_reads})')
       continue
     sscs = make_sscs(family, order, mate, qual_thres, cons_thres, min_cons_reads)
     sscss[(order, mate)] = sscs
@@ -382,8 +434,8 @@ def make_sscss(duplex, min_reads, cons_thres, min_cons_reads, qual_thres):
 
 
 def make_sscs(family, order, mate, qual_thres, cons_thres, min_cons_reads):
-  seqs = [read['seq'] for read in family]
-  quals = [read['qual'] for read in family]
+  # Each read is a (name, seq, qual) tuple.
+  names, seqs, quals = zip(*family)
   consensus_seq = consensus.get_consensus(
     seqs, quals, cons_thres=cons_thres, min_reads=min_cons_reads, qual_thres=qual_thres
   )
@@ -414,27 +466,75 @@ def make_dcss(sscss, aligner='biopython'):
       return []
     seq1 = sscs_pair[0]['seq']
     seq2 = sscs_pair[1]['seq']
-    if aligner == 'swalign':
-      # `local` here doesn't actually mean a local alignment. It just trims unaligned portions from
-      # the ends of the alignment.
-      align = swalign.smith_waterman(seq1, seq2, local=True)
-    elif aligner == 'biopython':
-      align = pair_align.align(seq1, seq2, scope='global', trim='true')
+    if seq1 == seq2 and seq1 and not seq1.strip('ACGT'):
+      # Identical strands made only of unambiguous bases align to themselves end to end, and their
+      # duplex consensus is the same sequence. No need to run the aligner.
+      dcs_seq = seq1
+    else:
+      align = ALIGNERS[aligner](seq1, seq2)
       if align is None:
-        # There was no successful alignment. Skip this family, since we can't make a complete pair
-        # of duplex consensus sequences.
+        # There was no successful alignment. Skip this family, since we can't make a complete
+        # pair of duplex consensus sequences.
         return []
-    if len(align.target) != len(align.query):
-      message = f'{len(align.target)} != {len(align.query)}:\n'
-      message += '\n'.join([repr(sscs) for sscs in sscs_pair])
-      raise AssertionError(message)
-    dcs_seq = consensus.build_consensus_duplex_simple(align.target, align.query)
+      if len(align.target) != len(align.query):
+        message = f'{len(align.target)} != {len(align.query)}:\n'
+        message += '\n'.join([repr(sscs) for sscs in sscs_pair])
+        raise AssertionError(message)
+      dcs_seq = consensus.build_consensus_duplex_simple(align.target, align.query)
     reads_per_strand = [sscs['nreads'] for sscs in sscs_pair]
     dcss.append({'seq':dcs_seq, 'nreads':reads_per_strand})
   assert len(dcss) == 0 or len(dcss) == 2, len(dcss)
   return dcss
 
 
+def align_swalign(seq1, seq2):
+  # `local` here doesn't actually mean a local alignment. It just trims unaligned portions from the
+  # ends of the alignment.
+  return swalign.smith_waterman(seq1, seq2, local=True)
+
+
+def align_biopython(seq1, seq2):
+  """Returns None if there was no successful alignment."""
+  return pair_align.align(seq1, seq2, scope='global', trim='true')
+
+
+def align_parasail(seq1, seq2):
+  """Align two sequences with parasail's striped Smith-Waterman.
+  Like swalign's local=True, the result only includes the aligned portion of the sequences."""
+  result = parasail.sw_trace_striped_16(
+    seq1, seq2, PARASAIL_GAP_OPEN, PARASAIL_GAP_EXTEND, parasail.dnafull
+  )
+  traceback = result.traceback
+  # Parasail's "query" is its first sequence, and its "ref" is the second.
+  return Alignment(target=traceback.query, query=traceback.ref)
+
+
+def align_edlib(seq1, seq2):
+  """Globally align two sequences with edlib's bit-parallel edit distance algorithm.
+  Columns at the ends of the alignment with a gap in either sequence are trimmed off."""
+  result = edlib.align(seq1, seq2, mode='NW', task='path')
+  nice = edlib.getNiceAlignment(result, seq1, seq2)
+  # edlib's "query" is its first sequence, and its "target" is the second.
+  return trim_end_gaps(nice['query_aligned'], nice['target_aligned'])
+
+
+def trim_end_gaps(target, query):
+  start = 0
+  end = len(target)
+  while start < end and (target[start] == '-' or query[start] == '-'):
+    start += 1
+  while end > start and (target[end-1] == '-' or query[end-1] == '-'):
+    end -= 1
+  return Alignment(target=target[start:end], query=query[start:end])
+
+
+# The pairwise alignment function for each --aligner.
+ALIGNERS = {
+  'swalign':align_swalign, 'biopython':align_biopython, 'parasail':align_parasail,
+  'edlib':align_edlib,
+}
+
+
 def format_outputs(dcss, sscss, barcode, output_qual=None):
   """Format the consensus sequences into FASTA/Q-formatted strings ready for printing.
   sscs_strs is structured so that sscs_strs[order][mate] is the FASTA/Q-formatted output string for
@@ -448,13 +548,12 @@ def format_outputs(dcss, sscss, barcode, output_qual=None):
     for mate in 0, 1:
       sscs = sscss.get((order, mate))
       if sscs and sscs['seq']:
+        seq = sscs['seq']
         if output_qual is None:
-          sscs_str_pair.append('>{bar}.{order} {nreads}\n{seq}\n'.format(bar=barcode, **sscs))
+          sscs_str_pair.append(f">{barcode}.{order} {sscs['nreads']}\n{seq}\n")
         else:
-          quals = output_qual * len(sscs['seq'])
-          sscs_str_pair.append(
-            '@{bar}.{order} {nreads}\n{seq}\n+\n{quals}\n'.format(bar=barcode, quals=quals, **sscs)
-          )
+          quals = output_qual * len(seq)
+          sscs_str_pair.append(f"@{barcode}.{order} {sscs['nreads']}\n{seq}\n+\n{quals}\n")
     if len(sscs_str_pair) == 2:
       sscs_strs[order] = sscs_str_pair
   # DCS
@@ -16,11 +16,13 @@ class SyncAsyncPool:
   the inputs were given. It does this by chunking the jobs, periodically stopping to wait for all
   jobs in the chunk to finish.
   It allows giving a callback which will be executed in the parent process. It will also be given
-  results in the same order they were submitted."""
+  results in the same order they were submitted.
+  Jobs can also be sent to the workers in batches, so that one round trip to a worker process
+  covers several of them. The callback still gets one call per job."""
 
   def __init__(
     self, function, processes=None, queue_size=None, static_args=(), static_kwargs=None,
-    callback=None, callback_args=()
+    callback=None, callback_args=(), batch_size=1, max_queue_cost=None
   ):
     """Create a new SyncAsyncPool.
     processes can be None, "auto", an integer 0 or greater, or something that produces an integer
@@ -29,7 +31,13 @@ class SyncAsyncPool:
       will execute the function directly in the main process (and won't actually create a
       multiprocessing.Pool).
     queue_size can be None or an integer greater than 0. If it's None, the queue_size will be set
-      to QUEUE_SIZE_MULTIPLIER * the number of processes."""
+      to QUEUE_SIZE_MULTIPLIER * the number of processes. When batching, this counts batches, not
+      individual jobs.
+    batch_size is the number of jobs to send to a worker at once. It has no effect when not using
+      subprocesses.
+    max_queue_cost can be None or a number greater than 0. If given, the queue is also flushed once
+      the total cost reported via add_cost() since the last flush reaches it. The units are up to
+      the caller (e.g. bytes of input data)."""
     # Validate arguments.
     if processes is not None and processes != 'auto':
       try:
@@ -42,6 +50,10 @@ class SyncAsyncPool:
       processes = None
     if queue_size is not None and queue_size <= 0:
       raise ValueError('queue_size must be > 0 (received {!r})'.format(queue_size))
+    if batch_size <= 0:
+      raise ValueError('batch_size must be > 0 (received {!r})'.format(batch_size))
+    if max_queue_cost is not None and max_queue_cost <= 0:
+      raise ValueError('max_queue_cost must be > 0 (received {!r})'.format(max_queue_cost))
     # Are we actually doing multiprocessing, or should we do everything directly in one process?
     if processes == 0:
       self.multiproc = False
@@ -73,7 +85,17 @@ class SyncAsyncPool:
       self.static_kwargs = static_kwargs
     self.callback = callback
     self.callback_args = callback_args
+    self.batch_size = batch_size
+    self.max_queue_cost = max_queue_cost
     self.results = []
+    # How many of the entries in self.results are waiting on a worker process.
+    self._pending = 0
+    # The jobs accumulated for the next batch. Each is either an (args, kwargs) tuple to send to a
+    # worker or a FakeResult that's already been computed locally.
+    self._batch = []
+    self._batch_jobs = 0
+    # The total cost of the jobs queued since the last flush.
+    self._cost = 0
 
   def compute(self, *args, **kwargs):
     # Combine the static arguments with the args for this invocation.
@@ -82,19 +104,80 @@ class SyncAsyncPool:
     all_kwargs.update(kwargs)
     # Send args to multiprocessing pool worker, or execute directly in this process if we're not
     # multiprocessing.
-    if self.multiproc:
+    if self.multiproc and self.batch_size > 1:
+      self._batch_jobs += 1
+      self._add_to_batch((all_args, all_kwargs))
+    elif self.multiproc:
       result = self._pool.apply_async(with_context, [self.function]+all_args, all_kwargs)
+      self._add_result(result)
+    else:
+      self._add_result(FakeResult(self.function(*all_args, **all_kwargs)))
+
+  def compute_locally(self, *args, **kwargs):
+    """Like compute(), but always execute the function directly in this process.
+    Useful for trivial jobs that cost less to do than to send to a worker. The result is still
+    queued with the others, so the callback sees it in the order it was submitted.
+    Local results don't count toward the queue_size or batch_size, since they aren't waiting on a
+    worker. But so they can't pile up without limit, QUEUE_SIZE_MULTIPLIER times those limits
+    still applies to them."""
+    all_args = list(args) + self.static_args
+    all_kwargs = self.static_kwargs.copy()
+    all_kwargs.update(kwargs)
+    result = FakeResult(self.function(*all_args, **all_kwargs))
+    if self.multiproc and self.batch_size > 1:
+      self._add_to_batch(result)
     else:
-      result = FakeResult(self.function(*all_args, **all_kwargs))
+      self._add_result(result, pending=not self.multiproc)
+
+  def add_cost(self, cost):
+    """Count the cost of a job toward max_queue_cost, flushing the queue if it's reached.
+    Call this after compute() so a single expensive job doesn't wait behind cheaper ones."""
+    if self.max_queue_cost is None:
+      return
+    self._cost += cost
+    if self._cost >= self.max_queue_cost:
+      self.flush()
+
+  def _add_to_batch(self, job):
+    self._batch.append(job)
+    if (self._batch_jobs >= self.batch_size or
+        len(self._batch) >= self.batch_size * QUEUE_SIZE_MULTIPLIER):
+      self._submit_batch()
+
+  def _submit_batch(self):
+    """Send the jobs in the current batch to a worker as a single task."""
+    jobs = [job for job in self._batch if not isinstance(job, FakeResult)]
+    if jobs:
+      async_result = self._pool.apply_async(with_context, [run_batch, self.function, jobs])
+    else:
+      async_result = None
+    # Keep the local results, but don't hold onto the args of the jobs sent to the worker.
+    slots = [job if isinstance(job, FakeResult) else None for job in self._batch]
+    self._batch = []
+    self._batch_jobs = 0
+    self._add_result(BatchResult(slots, async_result), pending=bool(jobs))
+
+  def _add_result(self, result, pending=True):
     self.results.append(result)
-    if len(self.results) >= self.queue_size:
+    if pending:
+      self._pending += 1
+    if (self._pending >= self.queue_size or
+        len(self.results) >= self.queue_size * QUEUE_SIZE_MULTIPLIER):
       self.flush()
-      self.results = []
 
   def flush(self):
+    if self._batch:
+      self._submit_batch()
     if self.callback:
       for result in self.results:
-        self.callback(result.get(), *self.callback_args)
+        if isinstance(result, BatchResult):
+          for result_data in result.get():
+            self.callback(result_data, *self.callback_args)
+        else:
+          self.callback(result.get(), *self.callback_args)
+    self.results = []
+    self._pending = 0
+    self._cost = 0
 
   def close(self):
     if self.multiproc:
@@ -114,6 +197,27 @@ class FakeResult(object):
     return self.result_data
 
 
+class BatchResult(object):
+  """Holds the results of a batch of jobs, in the order they were submitted.
+  Jobs which were computed locally are stored as FakeResults in `slots`. The rest are None, and
+  their results are filled in, in order, from the worker's list of results."""
+  def __init__(self, slots, async_result):
+    self.slots = slots
+    self.async_result = async_result
+  def get(self):
+    if self.async_result is None:
+      worker_results = iter(())
+    else:
+      worker_results = iter(self.async_result.get())
+    return [next(worker_results) if slot is None else slot.get() for slot in self.slots]
+
+
+def run_batch(fxn, jobs):
+  """Execute fxn on each (args, kwargs) in jobs and return the list of results.
+  NOTE: This must be a top-level function so it can be sent to the worker processes."""
+  return [fxn(*args, **kwargs) for args, kwargs in jobs]
+
+
 def with_context(fxn, *args, **kwargs):
   """Execute fxn, logging child process' stack trace for any Exceptions that are raised.
   When Exceptions are raised in a multiprocessing subprocess, the stack trace it gives ends where
@@ -5,10 +5,15 @@ import os
 import sys
 import logging
 import argparse
-import tempfile
 import subprocess
-import multiprocessing
+try:
+  from shutil import which
+except ImportError:
+  # Python 2 has no shutil.which().
+  from distutils.spawn import find_executable as which
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 import consensus
+import parallel_tools
 import swalign
 
 ARG_DEFAULTS = {'bar_len':24, 'win_len':5, 'shift':3, 'processes':1, 'loglevel':logging.ERROR}
@@ -69,11 +74,11 @@ def main(argv):
   last_barcode = None
   barcode_count = 0
   for line in infile:
-    fields = line.rstrip('\r\n').split('\t')
-    if len(fields) != 8:
+    # Only the barcode is needed, so count the fields instead of splitting out all 8.
+    if line.count('\t') != 7:
       logging.warn('Line contains incorrect number of fields.')
       continue
-    barcode = fields[0]
+    barcode = line[:line.index('\t')]
     # Only do it for each unique barcode (in the sorted output, there will be runs of lines with
     # the same barcode).
     if barcode == last_barcode:
@@ -94,32 +99,32 @@ def main(argv):
   if infile is not sys.stdin:
     infile.close()
 
-  workers = open_workers(args.processes)
+  # Use 0 worker subprocesses for -p 1, doing the work in this process.
+  processes = args.processes if args.processes > 1 else 0
+  pool = parallel_tools.SyncAsyncPool(
+    process_barcodes, processes=processes, callback=process_results,
+    callback_args=[args.consensus]
+  )
 
   # Analyze the groups of barcodes that contained each kmer:
   # Multiple sequence align all the barcodes in a each, call a consensus, then smith-waterman
   # align each barcode to that consensus to measure their similarity to it.
-  run_num = 0
-  for dict_num, kmer_dict in enumerate(kmer_dicts):
-    # Each half of the barcode (one dict per).
-    for kmer, barcodes_set in kmer_dict.items():
-      # Each set of barcodes which share a kmer.
-      barcodes = list(barcodes_set)
-      results = delegate(workers, run_num, dict_num, kmer, barcodes)
-      if results:
-        process_results(*results, print_consensus=args.consensus)
-      run_num += 1
-
-  # Do one last loop through the workers, reading the remaining results and stopping them.
-  # Start at the worker after the last one processed by the previous loop.
-  start_i = (run_num + 1) % len(workers)
-  for i in range(len(workers)):
-    worker_i = (start_i + i) % args.processes
-    worker = workers[worker_i]
-    results = worker.recv()
-    if results:
-      process_results(*results, print_consensus=args.consensus)
-    worker.send(None)
+  mafft_path = None
+  try:
+    for dict_num, kmer_dict in enumerate(kmer_dicts):
+      # Each half of the barcode (one dict per).
+      for kmer, barcodes_set in kmer_dict.items():
+        # Each set of barcodes which share a kmer.
+        # Find mafft once, and only when the first set that needs an alignment comes up.
+        if mafft_path is None and len(barcodes_set) > 1:
+          mafft_path = which('mafft')
+          if not mafft_path:
+            fail('Error: Could not find "mafft" command on $PATH.')
+        pool.compute(dict_num, kmer, list(barcodes_set), mafft_path=mafft_path)
+    pool.flush()
+  finally:
+    pool.close()
+    pool.join()
 
 
 def calc_starts(bar_len, win_len, shift):
@@ -135,67 +140,39 @@ def calc_starts(bar_len, win_len, shift):
   return start1, start2
 
 
-def process_results(dict_num, kmer, consensus_seq, barcodes, similarities, print_consensus=False):
+def process_results(results, print_consensus=False):
+  if not results:
+    return
+  dict_num, kmer, consensus_seq, barcodes, similarities = results
+  # Write all the lines for this kmer at once.
+  lines = []
   if print_consensus:
-    print(dict_num, kmer, consensus_seq, 1.0, sep='\t')
+    lines.append('{}\t{}\t{}\t{}\n'.format(dict_num, kmer, consensus_seq, 1.0))
   for barcode, similarity in zip(barcodes, similarities):
-    print(dict_num, kmer, barcode, similarity, sep='\t')
-
-
-def open_workers(num_workers):
-  """Open the required number of worker processes."""
-  workers = []
-  for i in range(num_workers):
-    parent_pipe, child_pipe = multiprocessing.Pipe()
-    process = multiprocessing.Process(target=worker_function, args=(child_pipe,))
-    process.start()
-    workers.append(parent_pipe)
-  return workers
-
-
-def delegate(workers, run_num, dict_num, kmer, barcodes):
-  worker_i = run_num % len(workers)
-  worker = workers[worker_i]
-  if run_num >= len(workers):
-    logging.info('Parent: Trying to receive results from worker..')
-    results = worker.recv()
-  else:
-    results = None
-  args = (dict_num, kmer, barcodes)
-  logging.info('Parent: Sending new data to worker..')
-  worker.send(args)
-  return results
-
-
-##### HAPPENS IN CHILD PROCESSES #####
-
-def worker_function(child_pipe):
-  while True:
-    # logging.info('Worker: Listening for new data from parent..')
-    args = child_pipe.recv()
-    if args is None:
-      break
-    # logging.info('Worker: Sending results back to parent..')
-    child_pipe.send(process_barcodes(*args))
+    lines.append('{}\t{}\t{}\t{}\n'.format(dict_num, kmer, barcode, similarity))
+  sys.stdout.write(''.join(lines))
 
 
-def process_barcodes(dict_num, kmer, barcodes):
+def process_barcodes(dict_num, kmer, barcodes, mafft_path='mafft'):
   """Perform a multiple sequence alignment on a set of barcodes and parse the result.
   Uses MAFFT."""
   # If there's only one barcode, we don't have to do an alignment.
   if len(barcodes) == 1:
     return dict_num, kmer, barcodes[0], barcodes, [1.0]
-  with tempfile.NamedTemporaryFile('w', delete=False, prefix='align.msa.') as family_file:
-    for i, barcode in enumerate(barcodes):
-      family_file.write('>{}\n'.format(i))
-      family_file.write(barcode+'\n')
-  with open(os.devnull, 'w') as devnull:
-    try:
-      command = ['mafft', '--nuc', '--quiet', family_file.name]
-      output = subprocess.check_output(command, stderr=devnull)
-    except (OSError, subprocess.CalledProcessError):
-      return None
-  os.remove(family_file.name)
+  fasta = ''.join(['>{}\n{}\n'.format(i, barcode) for i, barcode in enumerate(barcodes)])
+  # Feed the sequences to mafft through stdin instead of a temporary file.
+  command = [mafft_path, '--nuc', '--quiet', '/dev/stdin']
+  devnull = open(os.devnull, 'w')
+  try:
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=devnull, universal_newlines=True)
+    output = process.communicate(fasta)[0]
+  except OSError:
+    return None
+  finally:
+    devnull.close()
+  if process.returncode != 0:
+    return None
   alignment = read_fasta(output, upper=True)
   consensus_seq = consensus.get_consensus(alignment)
   similarities = []
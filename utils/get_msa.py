@@ -3,7 +3,6 @@ from __future__ import division
 import os
 import sys
 import argparse
-import tempfile
 import subprocess
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 import consensus
@@ -98,21 +97,20 @@ def parse_duplex(infile, mate, order):
 def make_msa(seqs):
   """Perform a multiple sequence alignment on a set of sequences.
   Uses MAFFT."""
-  i = 0
-  #TODO: Replace with tempfile.mkstemp()?
-  with tempfile.NamedTemporaryFile('w', delete=False, prefix='msa.') as family_file:
-    for seq in seqs:
-      i+=1
-      header = '>{}\n'.format(i)
-      family_file.write(header)
-      family_file.write(seq+'\n')
+  # Build the FASTA in memory and feed it to mafft through stdin, instead of a temporary file.
+  fasta = ''.join(['>{}\n{}\n'.format(i, seq) for i, seq in enumerate(seqs, 1)])
   with open(os.devnull, 'w') as devnull:
     try:
-      command = ['mafft', '--nuc', '--quiet', family_file.name]
-      output = subprocess.check_output(command, stderr=devnull)
-    except (OSError, subprocess.CalledProcessError):
+      command = ['mafft', '--nuc', '--quiet', '/dev/stdin']
+      process = subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull,
+        universal_newlines=True
+      )
+      output = process.communicate(fasta)[0]
+    except OSError:
       return None
-  os.remove(family_file.name)
+  if process.returncode != 0:
+    return None
   return read_fasta(output)
 
 